@@ -24,12 +24,450 @@ import sys
 import os
 import os.path
 import re
+import math
+import errno
+import threading
+import multiprocessing
 from debian import debtags
+import tagsnapshot
+import utils
+import bitsetdb
+import tagids
+from bitsetdb import popcount, bits_of_ids
 from subprocess import Popen, PIPE
 import collections
+import itertools
+import logging
+
+log = logging.getLogger(__name__)
 
 AprioriResult = collections.namedtuple("AprioriResult", ("src", "tgt", "sus", "conf"))
 
+class Transactions(object):
+    """
+    Package x tag incidence data, stored as one bitset column per tag.
+
+    Bit i of columns[t] is set if transaction (package) i has tag tags[t].
+    rows, if available, lists the tag IDs of each transaction.
+    """
+    def __init__(self, tags, columns, count, rows=None):
+        self.tags = tags
+        self.columns = columns
+        self.count = count
+        self.rows = rows
+
+    @classmethod
+    def from_db(cls, db, whitelist=None):
+        """
+        Encode the packages of a debtags.DB, skipping tags not in whitelist
+        and packages that end up with no tags, like run_apriori does when
+        feeding the apriori binary
+        """
+        if isinstance(db, bitsetdb.BitsetDB):
+            return cls.from_bitsetdb(db, whitelist)
+        ids = dict()
+        tags = []
+        rows = []
+        for pkg, ptags in db.iter_packages_tags():
+            if whitelist is not None:
+                ptags = ptags & whitelist
+            if not ptags: continue
+            row = []
+            for t in ptags:
+                tid = ids.get(t, None)
+                if tid is None:
+                    tid = ids[t] = len(tags)
+                    tags.append(t)
+                row.append(tid)
+            rows.append(tuple(row))
+        return cls(tags, cls.encode_columns(rows, len(tags)), len(rows), rows)
+
+    @classmethod
+    def from_bitsetdb(cls, db, whitelist=None):
+        """
+        Encode the packages of a BitsetDB, reusing its tag columns and only
+        renumbering its tag IDs.
+
+        Packages with no tags keep their (empty) bit in the columns, but are
+        not counted as transactions.
+        """
+        names = tagids.interner.tags
+        tids = sorted(tid for tid in db.columns if whitelist is None or names[tid] in whitelist)
+        local = dict((tid, i) for i, tid in enumerate(tids))
+        columns = [db.columns[tid] for tid in tids]
+        union = 0
+        for bits in columns:
+            union |= bits
+        rows = []
+        start = 0
+        for end in db.offsets:
+            rows.append(tuple(local[tid] for tid in db.rows[start:end] if tid in local))
+            start = end
+        return cls([names[tid] for tid in tids], columns, popcount(union), rows)
+
+    @classmethod
+    def from_matrix(cls, matrix, tags):
+        """
+        Encode a NumPy boolean matrix with one row per package and one column
+        per tag. Rows with no tags set are skipped.
+        """
+        import numpy
+        matrix = numpy.asarray(matrix, dtype=bool)
+        matrix = matrix[matrix.any(axis=1)]
+        columns = [bits_of_ids(numpy.flatnonzero(matrix[:, i]).tolist(), matrix.shape[0])
+                   for i in xrange(matrix.shape[1])]
+        rows = [tuple(numpy.flatnonzero(row).tolist()) for row in matrix]
+        return cls(list(tags), columns, matrix.shape[0], rows)
+
+    @staticmethod
+    def encode_columns(rows, tag_count):
+        """
+        Build the bitset columns for the given rows of tag IDs
+        """
+        by_tag = [[] for x in xrange(tag_count)]
+        for i, row in enumerate(rows):
+            for tid in row:
+                by_tag[tid].append(i)
+        return [bits_of_ids(ids, len(rows)) for ids in by_tag]
+
+    def restricted(self, min_card):
+        """
+        Return the Transactions with the columns of the tags with
+        cardinality lower than min_card cleared.
+
+        Tag IDs are preserved, and the transactions left without tags are not
+        counted anymore.
+        """
+        columns = []
+        union = 0
+        for bits in self.columns:
+            if popcount(bits) < min_card:
+                bits = 0
+            columns.append(bits)
+            union |= bits
+        return Transactions(self.tags, columns, popcount(union), self.rows)
+
+class Miner(object):
+    """
+    In-process association rule miner, accepting the same options and giving
+    the same results as the apriori binary run in rule mode (-tr)
+    """
+    def __init__(self, options=()):
+        # Minimum body support: percentage if positive, absolute if negative
+        self.supp = 10.0
+        # Minimum confidence (percentage)
+        self.conf = 80.0
+        # Maximum number of items in a rule, including the head
+        self.maxlen = None
+        # Additional evaluation measure (only "n", normalized chi^2, or None)
+        self.evaluation = None
+        # Minimum value of the evaluation measure (percentage)
+        self.eval_threshold = 10.0
+        for opt in options:
+            self.parse_option(opt)
+
+    def parse_option(self, opt):
+        """
+        Parse an apriori command line option
+        """
+        if len(opt) < 2 or opt[0] != "-":
+            raise ValueError("Unsupported apriori option '%s'" % opt)
+        name, value = opt[1], opt[2:]
+        if name == "s":
+            self.supp = float(value)
+        elif name == "c":
+            self.conf = float(value)
+        elif name == "n":
+            self.maxlen = int(value)
+        elif name == "e":
+            if value not in ("n", "x", ""):
+                raise ValueError("Unsupported apriori evaluation measure '%s'" % value)
+            self.evaluation = value if value == "n" else None
+        elif name == "d":
+            self.eval_threshold = float(value)
+        else:
+            raise ValueError("Unsupported apriori option '%s'" % opt)
+
+    def min_support(self, count):
+        """
+        Compute the absolute minimum body support for count transactions
+        """
+        if self.supp < 0:
+            return int(math.ceil(-self.supp))
+        return max(1, int(math.ceil(self.supp * count / 100.0)))
+
+    def frequent_bodies(self, transactions, smin):
+        """
+        Generate (items, bitset) for all rule bodies with at least smin
+        support, level by level as in the apriori algorithm
+        """
+        maxbody = None if self.maxlen is None else self.maxlen - 1
+        if maxbody is not None and maxbody < 1:
+            return
+
+        level = [((tid,), bits) for tid, bits in enumerate(transactions.columns)
+                 if popcount(bits) >= smin]
+        size = 1
+        while level:
+            for x in level:
+                yield x
+            if maxbody is not None and size >= maxbody:
+                break
+            # Join itemsets that share all but the last item
+            known = set(items for items, bits in level)
+            following = []
+            for i, (items, bits) in enumerate(level):
+                prefix = items[:-1]
+                for oitems, obits in level[i + 1:]:
+                    if oitems[:-1] != prefix: break
+                    cand = items + oitems[-1:]
+                    # Prune candidates with an infrequent subset
+                    if any(cand[:j] + cand[j + 1:] not in known for j in xrange(len(cand) - 2)):
+                        continue
+                    cbits = bits & obits
+                    if popcount(cbits) >= smin:
+                        following.append((cand, cbits))
+            level = following
+            size += 1
+
+    def chi2(self, n, body, head, both):
+        """
+        Normalized chi^2 measure of the dependency between body and head
+        """
+        den = float(body) * (n - body) * head * (n - head)
+        if den == 0: return 0.0
+        return (float(n) * both - float(body) * head) ** 2 / den
+
+    def mine(self, transactions):
+        """
+        Generate the AprioriResult tuples for the given Transactions.
+
+        Support and confidence are percentages rounded to one decimal digit,
+        as printed by the apriori binary.
+        """
+        n = transactions.count
+        if n == 0: return
+        tags = transactions.tags
+        columns = transactions.columns
+        counts = [popcount(bits) for bits in columns]
+        smin = self.min_support(n)
+
+        for items, bits in self.frequent_bodies(transactions, smin):
+            body = popcount(bits)
+            min_both = int(math.ceil(body * self.conf / 100.0 - 1e-9))
+            # With -c0, heads that never occur with the body are rules too:
+            # reverse mode is looking for exactly those
+            if self.conf > 0:
+                min_both = max(1, min_both)
+            src = None
+            for tid, col in enumerate(columns):
+                # Tags cleared by the card threshold are not items at all
+                if not counts[tid] or counts[tid] < min_both or tid in items: continue
+                both = popcount(bits & col)
+                if both < min_both: continue
+                conf = 100.0 * both / body
+                if conf < self.conf: continue
+                if self.evaluation == "n" and \
+                   100.0 * self.chi2(n, body, counts[tid], both) < self.eval_threshold:
+                    continue
+                if src is None:
+                    src = frozenset(tags[i] for i in items)
+                # Round like printf does when the binary prints its output
+                yield AprioriResult(src, tags[tid], float("%.1f" % (100.0 * body / n)), float("%.1f" % conf))
+
+class RuleIndex(object):
+    """
+    Index of AprioriResult rules by one of their antecedent tags, to quickly
+    find the rules that can fire for a given tag set.
+
+    Each rule is indexed under its rarest antecedent tag, so that looking up
+    the tags of a package only visits the rules that have a good chance of
+    matching.
+    """
+    def __init__(self, rules, card=None):
+        """
+        card, if given, is a function returning the cardinality of a tag, used
+        to pick the rarest antecedent of each rule
+        """
+        # Rules with an empty antecedent always fire
+        self.always = []
+        self.by_tag = dict()
+        if card is not None:
+            cache = dict()
+            def key(t):
+                res = cache.get(t, None)
+                if res is None:
+                    res = cache[t] = (card(t), t)
+                return res
+        else:
+            # min() does not accept key=None on Python 2
+            key = lambda t: t
+        for r in rules:
+            if not r.src:
+                self.always.append(r)
+                continue
+            self.by_tag.setdefault(min(r.src, key=key), []).append(r)
+
+    def matching(self, tags):
+        """
+        Generate all the rules whose antecedents are a subset of tags
+        """
+        for r in self.always:
+            yield r
+        for t in tags:
+            for r in self.by_tag.get(t, ()):
+                if r.src.issubset(tags):
+                    yield r
+
+    def consequents(self, tags):
+        """
+        Return the set of new tags suggested by the rules that fire for tags
+        """
+        return set(r.tgt for r in self.matching(tags) if r.tgt not in tags)
+
+class RulePruner(object):
+    """
+    Remove the rules made redundant by a rule with the same target and a
+    smaller antecedent: any tag set matching the larger antecedent also
+    matches the smaller one, so the larger rule never suggests anything new.
+
+    Only the antecedents of the rules that are kept are stored in memory.
+    """
+    def __init__(self, ordered=False):
+        """
+        If ordered is True, the rules to prune come by increasing antecedent
+        size, and can be passed on as soon as they are seen
+        """
+        self.ordered = ordered
+        self.seen = 0
+        self.dropped = 0
+        # tgt -> set of the antecedents of the rules kept so far
+        self.kept = dict()
+        # tgt -> src -> rule, for the rules kept so far when not ordered
+        self.pending = dict()
+
+    def is_redundant(self, rule):
+        """
+        Check if a rule is made redundant by one of the rules kept so far
+        """
+        kept = self.kept.get(rule.tgt, None)
+        if not kept: return False
+        if rule.src in kept: return True
+        size = len(rule.src)
+        if len(kept) < 2 ** size:
+            for src in kept:
+                if src < rule.src:
+                    return True
+        else:
+            for subsize in xrange(size):
+                for sub in itertools.combinations(rule.src, subsize):
+                    if frozenset(sub) in kept:
+                        return True
+        return False
+
+    def prune(self, rules):
+        """
+        Generate the rules that are not redundant
+        """
+        for rule in rules:
+            self.seen += 1
+            if self.is_redundant(rule):
+                self.dropped += 1
+                continue
+            kept = self.kept.setdefault(rule.tgt, set())
+            if self.ordered:
+                kept.add(rule.src)
+                yield rule
+                continue
+            # Forget the rules kept so far that this one makes redundant
+            pending = self.pending.setdefault(rule.tgt, dict())
+            for src in [x for x in pending if rule.src < x]:
+                del pending[src]
+                kept.discard(src)
+                self.dropped += 1
+            pending[rule.src] = rule
+            kept.add(rule.src)
+
+        for pending in self.pending.itervalues():
+            for rule in pending.itervalues():
+                yield rule
+        log.info("%d redundant rules dropped out of %d", self.dropped, self.seen)
+
+class RuleQuery(object):
+    """
+    Compute support and confidence of arbitrary rules on a debtags.DB,
+    without mining it.
+
+    Support and confidence are percentages, as in the apriori output, but
+    they are not rounded.
+    """
+    def __init__(self, db):
+        if isinstance(db, bitsetdb.BitsetDB):
+            # Use the bitsets of the database directly
+            self.bits = dict(db.iter_tags_bits())
+            self.all = 0
+            for bits in self.bits.itervalues():
+                self.all |= bits
+            self.count = popcount(self.all)
+            return
+
+        # Build a bitset of packages for each tag from the reverse index
+        ids = dict()
+        self.bits = dict()
+        for tag, pkgs in db.iter_tags_packages():
+            if not pkgs: continue
+            for pkg in pkgs:
+                if pkg not in ids:
+                    ids[pkg] = len(ids)
+            self.bits[tag] = bits_of_ids((ids[pkg] for pkg in pkgs), len(ids))
+        # Only packages with tags are counted, as when mining
+        self.count = len(ids)
+        self.all = (1 << self.count) - 1
+
+    def packages_bits(self, tags):
+        """
+        Return the bitset of the packages that have all the given tags
+        """
+        res = self.all
+        for t in tags:
+            res &= self.bits.get(t, 0)
+            if not res: break
+        return res
+
+    def support(self, tags):
+        """
+        Return the number of packages that have all the given tags
+        """
+        return popcount(self.packages_bits(tags))
+
+    def query(self, src, tgt):
+        """
+        Return an AprioriResult with support and confidence of src -> tgt
+        """
+        return self.query_many(((src, tgt),))[0]
+
+    def query_many(self, rules):
+        """
+        Return AprioriResult tuples with support and confidence of a sequence
+        of (src, tgt) rules
+        """
+        res = []
+        bodies = dict()
+        for src, tgt in rules:
+            src = frozenset(src)
+            body = bodies.get(src, None)
+            if body is None:
+                bits = self.packages_bits(src)
+                body = bodies[src] = (bits, popcount(bits))
+            bits, count = body
+            if count:
+                conf = 100.0 * popcount(bits & self.bits.get(tgt, 0)) / count
+            else:
+                conf = 0.0
+            sus = 100.0 * count / self.count if self.count else 0.0
+            res.append(AprioriResult(src, tgt, sus, conf))
+        return res
+
 class Apriori(object):
     def __init__(self, quiet=False, **kw):
         """
@@ -40,13 +478,23 @@ class Apriori(object):
         association happens)
         """
         self.conf_apriori = "./apriori"
+        # Apriori implementation: "binary" runs conf_apriori, "builtin" uses
+        # the in-process Miner, None uses the binary only if it is available
+        self.conf_engine = None
+        # Seconds after which apriori is killed (None means no timeout)
+        self.conf_timeout = None
+        # Buffer size for the pipes to and from apriori
+        self.conf_bufsize = 64 * 1024
         # Whether apriori's stderr should be redirected to /dev/null
         self.conf_apriori_quiet = quiet
         # Minimum cardinality a tag should have to be fed to apriori
         self.conf_card_threshold = 30
+        # Whether to drop rules made redundant by more general ones
+        self.conf_prune = False
         self.pick_defaults(**kw)
 
     def pick_defaults(self, reverse=False):
+        self.conf_reverse = reverse
         if not reverse:
             # Default apriori options
             # -s: Minimum support an itemset should have to be considered
@@ -65,68 +513,238 @@ class Apriori(object):
             # almost never happens')
             self.conf_filter = lambda r:r.conf < 1.0
 
+    def parameters(self):
+        """
+        Return a JSON-serializable description of the mining parameters
+        """
+        return dict(
+            options=list(self.conf_apriori_options),
+            card_threshold=self.conf_card_threshold,
+            reverse=self.conf_reverse,
+            prune=self.conf_prune,
+            engine="binary" if self.use_binary() else "builtin",
+        )
+
+    def use_binary(self):
+        """
+        Check if rules should be mined with the apriori binary
+        """
+        if self.conf_engine is None:
+            return os.access(self.conf_apriori, os.X_OK)
+        return self.conf_engine == "binary"
+
     def run_apriori(self, db):
         """
         Run apriori with the given tag collection, generating AprioriResult
         tuples
         """
+        return self.run_transactions(Transactions.from_db(db))
+
+    def run_transactions(self, transactions):
+        """
+        Run apriori on an already encoded tag collection, generating
+        AprioriResult tuples.
 
-        # Compute a blacklist with the tags with insufficient cardinality
+        The same Transactions can be reused for any number of runs.
+        """
+        rules = self._mine_transactions(transactions)
+        if not self.conf_prune:
+            return rules
+        # The builtin miner generates rules by increasing antecedent size
+        return RulePruner(ordered=not self.use_binary()).prune(rules)
+
+    def _mine_transactions(self, transactions):
+        # Leave out the tags with insufficient cardinality
         if self.conf_card_threshold:
-            whitelist = set(t for t, pkgs in db.iter_tags_packages() if len(pkgs) >= self.conf_card_threshold)
-        else:
-            whitelist = None
+            transactions = transactions.restricted(self.conf_card_threshold)
+
+        if not self.use_binary():
+            miner = Miner(self.conf_apriori_options)
+            for rule in miner.mine(transactions):
+                if self.conf_filter(rule):
+                    yield rule
+            return
+
+        if transactions.rows is None:
+            raise ValueError("apriori needs Transactions with rows")
 
         # Run the algorithm
         cmdline = (self.conf_apriori, "-tr") + self.conf_apriori_options + ("-", "-")
         if self.conf_apriori_quiet:
             with open("/dev/null", "w") as nullfd:
-                apriori = Popen(cmdline, stdin=PIPE, stdout=PIPE, stderr=nullfd.fileno())
+                apriori = Popen(cmdline, stdin=PIPE, stdout=PIPE, stderr=nullfd.fileno(), bufsize=self.conf_bufsize)
         else:
-            apriori = Popen(cmdline, stdin=PIPE, stdout=PIPE)
+            apriori = Popen(cmdline, stdin=PIPE, stdout=PIPE, bufsize=self.conf_bufsize)
 
-        # Feed it the input data
-        for pkg, tags in db.iter_packages_tags():
-            if whitelist is not None:
-                tags = tags & whitelist
-            if tags:
-                print >>apriori.stdin, " ".join(tags)
-        apriori.stdin.close()
+        # Feed it the input data from a separate thread, so that its output
+        # is parsed while it is still reading. The pipes provide
+        # backpressure: each side blocks when the other is not keeping up
+        errors = []
+        feeder = threading.Thread(target=self._feed_apriori, args=(apriori.stdin, transactions, errors))
+        feeder.daemon = True
+        feeder.start()
+
+        # Kill apriori if it takes too long
+        timed_out = []
+        timer = None
+        if self.conf_timeout:
+            def on_timeout():
+                timed_out.append(True)
+                apriori.kill()
+            timer = threading.Timer(self.conf_timeout, on_timeout)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            # Read results
+            for x in self._parse_apriori_output(apriori.stdout, transactions.tags):
+                yield x
 
-        # Read results
-        for x in self._parse_apriori_output(apriori.stdout):
-            yield x
+            # Wait for the program to finish
+            status = apriori.wait()
+        finally:
+            if timer is not None:
+                timer.cancel()
+            # Do not leave apriori running if we are interrupted
+            if apriori.poll() is None:
+                apriori.kill()
+                apriori.wait()
+            feeder.join()
+            apriori.stdout.close()
 
-        # Wait for the program to finish
-        status = apriori.wait()
+        if timed_out:
+            raise RuntimeError("%s timed out after %s seconds" % (self.conf_apriori, self.conf_timeout))
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
         #  0: success
         # 15: E_NOITEMS
         if status not in [0, 15]:
             raise RuntimeError("%s exited with status %d" % (self.conf_apriori, status))
 
-    def _parse_apriori_output(self, fd):
+    def _feed_apriori(self, fd, transactions, errors):
         """
-        Parse the apriori output generating the broken down values
+        Write the transactions to apriori's standard input as tag IDs,
+        collecting the details of any exception in errors
         """
-        re_line = re.compile(r"^(\S+)\s+<-\s+(.+?)\s+\(([0-9.]+), ([0-9.]+)\)\s*$")
-        for line in fd:
-            m = re_line.match(line)
-            if not m: continue
-            tgt, src, sus, conf = m.groups()
-            rule = AprioriResult(frozenset(src.split(' ')), tgt, float(sus), float(conf))
+        try:
+            # Tags left out by Transactions.restricted have empty columns
+            ids = [str(tid) if bits else None for tid, bits in enumerate(transactions.columns)]
+            for row in transactions.rows:
+                items = [ids[tid] for tid in row if ids[tid] is not None]
+                if items:
+                    print >>fd, " ".join(items)
+        except IOError as e:
+            # If apriori went away, its exit status tells why
+            if e.errno != errno.EPIPE:
+                errors.append(sys.exc_info())
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            try:
+                fd.close()
+            except IOError:
+                pass
+
+    def _parse_apriori_output(self, fd, tags=None):
+        """
+        Parse the apriori output generating the broken down values.
+
+        If tags is given, items in the output are indices in it.
+
+        The output is read in large blocks, and equal tags and antecedent
+        sets are shared among all the rules.
+        """
+        items = dict()
+        srcs = dict()
+
+        def item(name):
+            res = items.get(name, None)
+            if res is None:
+                res = items[name] = tags[int(name)] if tags is not None else intern(name)
+            return res
+
+        for line in utils.read_lines(fd, self.conf_bufsize):
+            # Lines look like: "tgt <- src1 src2 (sus, conf)"
+            pos = line.find(" <- ")
+            if pos == -1: continue
+            paren = line.rfind(" (")
+            # Skip rules with an empty antecedent
+            if paren < pos + 4: continue
+            values = line[paren + 2:].rstrip()
+            if not values.endswith(")"): continue
+            sus, sep, conf = values[:-1].partition(", ")
+            try:
+                sus, conf = float(sus), float(conf)
+            except ValueError:
+                continue
+
+            text = line[pos + 4:paren]
+            src = srcs.get(text, None)
+            if src is None:
+                src = srcs[text] = frozenset(item(x) for x in text.split())
+            rule = AprioriResult(src, item(line[:pos].strip()), sus, conf)
             if self.conf_filter(rule):
                 yield rule
 
     @classmethod
-    def read_debtags_db(cls, fname):
+    def read_debtags_db(cls, fname, snapshot=False, snapshot_dir=None, bitset=False):
         """
         Read a debtags database, filtering out tags that we usually do not want
-        in the computation
+        in the computation.
+
+        If snapshot is True, the filtered database is cached in a snapshot
+        file in snapshot_dir, or next to fname by default (see
+        tagsnapshot.read_tags). If bitset is True, the result is a read-only
+        bitsetdb.BitsetDB.
         """
-        db = debtags.DB()
         tag_filter = re.compile(r"^(?:special::.+|.+:special:.+|.+:TODO|.+:todo)$")
+        if snapshot:
+            return tagsnapshot.read_tags(fname, lambda x: not tag_filter.match(x),
+                                         filter_key=tag_filter.pattern,
+                                         snapshot_dir=snapshot_dir, bitset=bitset)
+        db = debtags.DB()
         with open(fname, "r") as fd:
             db.read(fd, lambda x: not tag_filter.match(x))
+        if bitset:
+            return bitsetdb.BitsetDB.from_db(db)
         return db
 
 
+
+# Encoded transactions and configurations of the running sweep, inherited by
+# the worker processes when they are forked
+_sweep_state = None
+
+def _sweep_worker(name):
+    transactions, configs = _sweep_state
+    return name, list(configs[name].run_transactions(transactions))
+
+def sweep(db, configs, processes=None):
+    """
+    Run several Apriori configurations on the same tag collection, encoding
+    it only once.
+
+    db can be a debtags.DB or Transactions. configs is a dict mapping names
+    to Apriori objects, and the result maps the same names to lists of
+    AprioriResult tuples. If processes is more than 1, configurations are run
+    in parallel in that many worker processes.
+    """
+    global _sweep_state
+    if isinstance(db, Transactions):
+        transactions = db
+    else:
+        transactions = Transactions.from_db(db)
+
+    if not processes or processes < 2 or len(configs) < 2:
+        return dict((name, list(apriori.run_transactions(transactions)))
+                    for name, apriori in configs.iteritems())
+
+    _sweep_state = (transactions, configs)
+    pool = multiprocessing.Pool(min(processes, len(configs)))
+    try:
+        return dict(pool.map(_sweep_worker, configs.keys()))
+    finally:
+        pool.terminate()
+        pool.join()
+        _sweep_state = None
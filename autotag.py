@@ -2,9 +2,11 @@ import re
 import os.path
 import datasources
 import patches
-import cPickle as pickle
+import apriori
+import rulestore
 
-# Set this to a pathname to point to the pickled apriori rule cache
+# Set this to a pathname to point to the apriori rule store (see
+# rulestore.build)
 APRIORI_CACHE = None
 
 class RuleSections(datasources.Action):
@@ -38,19 +40,24 @@ class RuleUIToolkit(datasources.Action):
             (re.compile("^libwxgtk"), "uitoolkit::wxwidgets"),
         )
 
-        for name, pkg in self.src_binpackages.by_name.iteritems():
-            # Skip libraries
-            if pkg.sec.startswith("lib"): continue
+        # Match each depended upon package name once, then walk back to the
+        # packages that depend on it
+        graph = self.src_binpackages.depgraph
+        by_name = self.src_binpackages.by_name
+        added = dict()
+        for pid, dep in enumerate(graph.names):
+            for regexp, newtag in re_maps:
+                if regexp.match(dep):
+                    break
+            else:
+                continue
+            for src in graph.reverse(pid, fields=("predeps", "deps"), first_only=True):
+                added.setdefault(graph.names[src], set()).add(newtag)
 
-            added = set()
-            for dep in pkg.predeps, pkg.deps:
-                for deppkg in dep:
-                    for regexp, newtag in re_maps:
-                        if regexp.match(deppkg):
-                            added.add(newtag)
-                            break
-            if added:
-                yield name, added, frozenset()
+        for name, tags in added.iteritems():
+            # Skip libraries
+            if by_name[name].sec.startswith("lib"): continue
+            yield name, tags, frozenset()
 
 class RuleKernel(datasources.Action):
     NEED_SOURCES = ("binpackages",)
@@ -120,26 +127,16 @@ class RuleApriori(datasources.Action):
     NEED_SOURCES = ("stabletags",)
 
     def make_patch(self):
-        rules = None
-
         # Load rules database
         if APRIORI_CACHE is None: return
-        if os.path.exists(APRIORI_CACHE):
-            with open(APRIORI_CACHE) as fd:
-                rules = pickle.load(fd)
-        if rules is None: return
-
-        # We cannot evaluate facet rules, because they give facet suggestions,
-        # not actual tags to add
-        rules = rules["t"]
+        if not os.path.exists(APRIORI_CACHE): return
+        db = self.src_stabletags.db
+        with rulestore.RuleStore(APRIORI_CACHE) as rules:
+            index = apriori.RuleIndex(rules, db.card)
 
         # Evaluate tag rules
-        db = self.src_stabletags.db
         for pkg, tags in db.iter_packages_tags():
-            added = set()
-            for r in rules:
-                if r.src.issubset(tags) and r.tgt not in tags:
-                    added.add(r.tgt)
+            added = index.consequents(tags)
             if added:
                 yield pkg, added, frozenset()
 
@@ -0,0 +1,189 @@
+"""
+Benchmarks for data loading and processing.
+
+Usage: python -m debdata.bench benchmark [args...]
+"""
+import sys
+import os
+import os.path
+import time
+import tempfile
+import shutil
+import gc
+import multiprocessing
+import tagsnapshot
+import datasources
+import patches
+
+def timed(func, *args, **kw):
+    """
+    Call func, returning the elapsed time and its result
+    """
+    start = time.time()
+    res = func(*args, **kw)
+    return time.time() - start, res
+
+def bench_tags_snapshot(fname):
+    """
+    Compare loading a tag database with and without a snapshot
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        snapshot_fname = os.path.join(tmpdir, "snapshot")
+        cold, db = timed(tagsnapshot.read_tags, fname, snapshot_fname=snapshot_fname)
+        warm, db = timed(tagsnapshot.read_tags, fname, snapshot_fname=snapshot_fname)
+        print "%s: %d packages, %d tags" % (fname, db.package_count(), db.tag_count())
+        print "cold (parse and build snapshot): %.3fs" % cold
+        print "warm (load snapshot): %.3fs" % warm
+    finally:
+        shutil.rmtree(tmpdir)
+
+def rss():
+    """
+    Return the resident set size of this process, in KiB
+    """
+    with open("/proc/self/status") as fd:
+        for line in fd:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def _memory_of(func, args):
+    gc.collect()
+    before = rss()
+    res = func(*args)
+    gc.collect()
+    return rss() - before
+
+def in_child(func, *args):
+    """
+    Run func in a new process, returning its result
+    """
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(func, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+def memory_of(func, *args):
+    """
+    Run func in a new process, returning how much its resident set size
+    grew, in KiB. The result of func is kept alive while measuring.
+    """
+    return in_child(_memory_of, func, args)
+
+def _load_binpackages(fname, compact):
+    src = datasources.BinPackages(fname)
+    src.load(compact=compact)
+    return src
+
+def bench_binpackages_memory(fname):
+    """
+    Compare memory used by BinPackages with and without the compact store
+    """
+    for compact in False, True:
+        elapsed, src = timed(_load_binpackages, fname, compact)
+        print "compact=%s: %d packages, loaded in %.3fs, %d KiB RSS" % (
+            compact, len(src.by_name), elapsed, memory_of(_load_binpackages, fname, compact))
+
+def _read_tags(fname, bitset):
+    return tagsnapshot.read_tags(fname, snapshot_fname=fname + ".bench-snapshot", bitset=bitset)
+
+def bench_bitsetdb(fname):
+    """
+    Compare debtags.DB and bitsetdb.BitsetDB loaded from a snapshot
+    """
+    try:
+        # Build the snapshot, and measure memory before this process
+        # allocates anything
+        memory_of(_read_tags, fname, False)
+        memory = dict((bitset, memory_of(_read_tags, fname, bitset)) for bitset in (False, True))
+        for bitset in False, True:
+            elapsed, db = timed(_read_tags, fname, bitset)
+            tags = list(db.iter_tags())
+            card, res = timed(lambda: [db.card(t) for t in tags])
+            print "bitset=%s: %d packages, loaded in %.3fs, %d KiB RSS, card of all tags in %.4fs" % (
+                bitset, db.package_count(), elapsed, memory[bitset], card)
+    finally:
+        os.unlink(fname + ".bench-snapshot")
+
+def _write_unique_patches(fname, count):
+    """
+    Write a patch file where no two patches add the same tags
+    """
+    with open(fname, "w") as fd:
+        for i in xrange(count):
+            print >>fd, "pkg%d: +role::program, +unique::tag%d" % (i, i)
+
+def bench_patchset_memory(fname=None, count="100000"):
+    """
+    Measure memory used by a PatchSet read from a patch file, if given, and
+    by one of count patches that all add different tag sets, where sharing
+    tag sets cannot save anything
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        unique = os.path.join(tmpdir, "unique")
+        _write_unique_patches(unique, int(count))
+        for name in filter(None, (fname, unique)):
+            memory = memory_of(patches.PatchSet, name)
+            elapsed, ps = timed(patches.PatchSet, name)
+            print "%s: %d patches, %d distinct added sets, read in %.3fs, %d KiB RSS (%d bytes per patch)" % (
+                "unique sets" if name == unique else name,
+                len(ps), len(set(frozenset(p.added) for p in ps.itervalues())), elapsed, memory,
+                memory * 1024 / max(len(ps), 1))
+            del ps
+    finally:
+        shutil.rmtree(tmpdir)
+
+def _merge_peak_memory(fnames):
+    """
+    Stream the merge of the given patch files, returning how much the
+    resident set size grew at most while doing it, in KiB
+    """
+    gc.collect()
+    before = peak = rss()
+    for i, item in enumerate(patches.iter_merged(fnames)):
+        if i % 1000 == 0:
+            peak = max(peak, rss())
+    return peak - before
+
+def bench_merge_many(count="100", size="30000"):
+    """
+    Measure memory used while merging count sorted patch files of size
+    patches each, like PatchSet.merge_many does
+    """
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fnames = []
+        for i in xrange(int(count)):
+            fnames.append(os.path.join(tmpdir, "patch%d" % i))
+            with open(fnames[-1], "w") as fd:
+                for j in xrange(int(size)):
+                    print >>fd, "pkg%07d: +role::program, +source::tag%d" % (j * int(count) + i, i)
+        total = sum(os.path.getsize(f) for f in fnames)
+        elapsed, res = timed(lambda: sum(1 for x in patches.iter_merged(fnames)))
+        print "%d files, %d KiB: merged %d patches in %.3fs, %d KiB RSS at most" % (
+            len(fnames), total / 1024, res, elapsed, in_child(_merge_peak_memory, fnames))
+    finally:
+        shutil.rmtree(tmpdir)
+
+BENCHMARKS = dict(
+    tags_snapshot=bench_tags_snapshot,
+    binpackages_memory=bench_binpackages_memory,
+    bitsetdb=bench_bitsetdb,
+    patchset_memory=bench_patchset_memory,
+    merge_many=bench_merge_many,
+)
+
+def main(args):
+    if not args or args[0] not in BENCHMARKS:
+        print >>sys.stderr, "Usage: python -m debdata.bench benchmark [args...]"
+        print >>sys.stderr, "Benchmarks: %s" % ", ".join(sorted(BENCHMARKS))
+        return 1
+    BENCHMARKS[args[0]](*args[1:])
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,236 @@
+import array
+import binascii
+import tagids
+
+def bits_of_ids(ids, count):
+    """
+    Make a bitset integer with the given bit positions set, all below count
+    """
+    bitmap = bytearray((count + 7) // 8)
+    for i in ids:
+        bitmap[i >> 3] |= 1 << (i & 7)
+    if not bitmap:
+        return 0
+    return int(binascii.hexlify(str(bitmap[::-1])), 16)
+
+# Byte value -> number of bits set in it
+POPCOUNT_TABLE = "".join(chr(bin(i).count("1")) for i in xrange(256))
+
+def popcount(bits):
+    """
+    Count the bits set in a bitset integer
+    """
+    digits = "%x" % bits
+    if len(digits) % 2:
+        digits = "0" + digits
+    # Twice as fast as bin(bits).count("1") on large bitsets
+    return sum(bytearray(binascii.unhexlify(digits).translate(POPCOUNT_TABLE)))
+
+def ids_of_bits(bits):
+    """
+    Generate the positions of the bits set in a bitset integer
+    """
+    # Walk the set bits through the binary representation, which is much
+    # faster than shifting a large integer
+    digits = bin(bits)[:1:-1]
+    pos = digits.find("1")
+    while pos != -1:
+        yield pos
+        pos = digits.find("1", pos + 1)
+
+class BitsetDB(object):
+    """
+    Read-only tag database with the read API of debtags.DB, backed by
+    compact arrays of tag IDs for each package and by a bitset of packages
+    for each tag.
+
+    Tag IDs are those of tagids.interner, and are translated to and from
+    tag names when pickling. Sets returned by the debtags.DB-like methods
+    are new sets, which can be modified freely.
+    """
+    def __init__(self, pkgs, rows, offsets):
+        """
+        pkgs is the list of package names, rows is an array of interned tag
+        IDs and offsets is an array with the position in rows where the
+        tags of each package end
+        """
+        self.pkgs = pkgs
+        self.pkg_ids = dict((p, i) for i, p in enumerate(pkgs))
+        self.rows = rows
+        self.offsets = offsets
+
+        # Tag ID -> package IDs
+        by_tag = dict()
+        start = 0
+        for pid, end in enumerate(offsets):
+            for tid in rows[start:end]:
+                by_tag.setdefault(tid, []).append(pid)
+            start = end
+        count = len(pkgs)
+        self.columns = dict((tid, bits_of_ids(pids, count)) for tid, pids in by_tag.iteritems())
+        self.counts = dict((tid, len(pids)) for tid, pids in by_tag.iteritems())
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """
+        Build from a sequence of (package, tags) pairs
+        """
+        pkgs = []
+        rows = array.array("I")
+        offsets = array.array("I")
+        tag_id = tagids.interner.tag_id
+        for pkg, tags in pairs:
+            pkgs.append(pkg)
+            rows.extend(sorted(tag_id(t) for t in tags))
+            offsets.append(len(rows))
+        return cls(pkgs, rows, offsets)
+
+    @classmethod
+    def from_db(cls, db):
+        """
+        Build from a debtags.DB
+        """
+        return cls.from_pairs(db.iter_packages_tags())
+
+    @classmethod
+    def from_arrays(cls, pkgs, tags, ids, offsets):
+        """
+        Build from the arrays of a tag snapshot: ids has, for each package,
+        the indices in tags of its tags
+        """
+        tag_map = [tagids.interner.tag_id(t) for t in tags]
+        rows = array.array("I", (tag_map[i] for i in ids))
+        return cls(pkgs, rows, array.array("I", offsets))
+
+    def __getstate__(self):
+        # Tag IDs are only valid in this process: pickle tag names, which
+        # are interned again when unpickling
+        tids = sorted(self.columns)
+        local = dict((tid, i) for i, tid in enumerate(tids))
+        ids = array.array("I", (local[tid] for tid in self.rows))
+        return dict(pkgs=self.pkgs, tags=[tagids.interner.tags[tid] for tid in tids],
+                    ids=ids.tostring(), offsets=self.offsets.tostring())
+
+    def __setstate__(self, state):
+        tag_map = [tagids.interner.tag_id(t) for t in state["tags"]]
+        rows = array.array("I", (tag_map[i] for i in array.array("I", state["ids"])))
+        self.__init__(state["pkgs"], rows, array.array("I", state["offsets"]))
+
+    def _tag_ids(self, pid):
+        start = self.offsets[pid - 1] if pid else 0
+        return self.rows[start:self.offsets[pid]]
+
+    def _tid(self, tag):
+        """
+        Return the interned ID of tag, or None if no package has it
+        """
+        tid = tagids.interner.tag_ids_by_name.get(tag, None)
+        if tid is None or tid not in self.columns:
+            return None
+        return tid
+
+    # debtags.DB read API
+
+    def has_package(self, pkg):
+        return pkg in self.pkg_ids
+
+    def has_tag(self, tag):
+        return self._tid(tag) is not None
+
+    def tags_of_package(self, pkg):
+        pid = self.pkg_ids.get(pkg, None)
+        if pid is None: return set()
+        return set(map(tagids.interner.tags.__getitem__, self._tag_ids(pid)))
+
+    def packages_of_tag(self, tag):
+        return self.packages_of_bits(self.tag_bits(tag))
+
+    def card(self, tag):
+        tid = self._tid(tag)
+        if tid is None: return 0
+        return self.counts[tid]
+
+    def iter_packages(self):
+        return iter(self.pkgs)
+
+    def iter_tags(self):
+        tags = tagids.interner.tags
+        return (tags[tid] for tid in self.columns)
+
+    def iter_packages_tags(self):
+        tags = tagids.interner.tags
+        start = 0
+        for pkg, end in zip(self.pkgs, self.offsets):
+            yield pkg, set(map(tags.__getitem__, self.rows[start:end]))
+            start = end
+
+    def iter_tags_packages(self):
+        tags = tagids.interner.tags
+        for tid, bits in self.columns.iteritems():
+            yield tags[tid], self.packages_of_bits(bits)
+
+    def package_count(self):
+        return len(self.pkgs)
+
+    def tag_count(self):
+        return len(self.columns)
+
+    # Set algebra on bitsets of package IDs
+
+    def iter_tags_bits(self):
+        """
+        Iterate over (tag, bitset of packages) pairs
+        """
+        tags = tagids.interner.tags
+        for tid, bits in self.columns.iteritems():
+            yield tags[tid], bits
+
+    def tag_bits(self, tag):
+        """
+        Return the bitset of the packages with the given tag
+        """
+        tid = self._tid(tag)
+        if tid is None: return 0
+        return self.columns[tid]
+
+    def packages_of_bits(self, bits):
+        """
+        Return the set of the names of the packages in a bitset
+        """
+        pkgs = self.pkgs
+        return set(pkgs[i] for i in ids_of_bits(bits))
+
+    def all_bits(self):
+        """
+        Return the bitset of all packages
+        """
+        return (1 << len(self.pkgs)) - 1
+
+    def with_all(self, tags):
+        """
+        Return the bitset of the packages that have all the given tags
+        """
+        res = None
+        for t in tags:
+            bits = self.tag_bits(t)
+            res = bits if res is None else res & bits
+            if not res: break
+        if res is None:
+            return self.all_bits()
+        return res
+
+    def with_any(self, tags):
+        """
+        Return the bitset of the packages that have any of the given tags
+        """
+        res = 0
+        for t in tags:
+            res |= self.tag_bits(t)
+        return res
+
+    @staticmethod
+    def count(bits):
+        """
+        Return the number of packages in a bitset
+        """
+        return popcount(bits)
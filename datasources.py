@@ -1,17 +1,30 @@
 import os
 import os.path
+import sys
 import re
+import time
+import threading
+import traceback
 import rfc822
 from debian import debtags, deb822
 import logging
 import collections
+import multiprocessing
+import array
+import marshal
 import utils
+import tagsnapshot
+import depgraph
+import tagids
+import bitsetdb
 
 log = logging.getLogger(__name__)
 
 class DataSource(object):
     def __init__(self, datafile, **kw):
         self.datafile = datafile
+        # Fingerprint of datafile as it was when the source was last loaded
+        self.loaded_fingerprint = None
 
     @classmethod
     def create(cls, datadir, **kw):
@@ -23,81 +36,738 @@ class DataSource(object):
             datafile = None
         return cls(datafile, **kw)
 
+    def after_load(self):
+        """
+        Hook run in the main process once the source has been loaded
+        """
+        pass
+
+    def fingerprint(self):
+        """
+        Return the (size, mtime, content hash) of the data file, or an empty
+        tuple if the source has no data file.
+
+        The content hash is left as None, to be computed by changed() only
+        once it is needed.
+        """
+        if self.datafile is None:
+            return ()
+        size, mtime = utils.file_key(self.datafile)
+        return size, mtime, None
+
+    def changed(self):
+        """
+        Check if the data file changed since the source was last loaded
+        """
+        old = self.loaded_fingerprint
+        if old is None:
+            return True
+        if self.datafile is None:
+            return False
+        try:
+            key = utils.unchanged_file_key(self.datafile, *old)
+        except OSError:
+            # Vanished data file: let the reload report the error
+            return True
+        if key is None:
+            return True
+        if old[2] is None:
+            # Hash the file while it is still the one that was loaded, to
+            # tell later touches from changes
+            self._remember_hash(*key)
+        else:
+            # Do not hash a touched file again on the next check
+            self.loaded_fingerprint = key + (old[2],)
+        return False
+
+    def _remember_hash(self, size, mtime):
+        """
+        Add the content hash to loaded_fingerprint, unless the data file is
+        modified while hashing it
+        """
+        digest = utils.file_fingerprint(self.datafile)
+        if utils.file_key(self.datafile) == (size, mtime):
+            self.loaded_fingerprint = (size, mtime, digest)
+
+def decode(value):
+    """
+    Decode a field value like deb822 does
+    """
+    try:
+        return value.decode("utf-8")
+    except UnicodeDecodeError:
+        return value.decode("latin-1")
+
+def parse_paragraphs(lines, fields):
+    """
+    Parse deb822 paragraphs from a sequence of lines, generating a dict with
+    the values of the given fields for each of them.
+
+    Field names are matched case insensitively, and results use the names
+    as given in fields. Values are decoded and folded like deb822 does.
+    """
+    wanted = dict((f.lower(), f) for f in fields)
+    para = dict()
+    # Name and list of lines of the field being parsed, if it is wanted
+    curkey = None
+    content = None
+    for line in lines:
+        if line.endswith("\r"):
+            line = line.rstrip("\r")
+        if not line or line.isspace():
+            # End of paragraph
+            if curkey is not None:
+                para[curkey] = decode("\n".join(content))
+                curkey = None
+            if para:
+                yield para
+                para = dict()
+            continue
+        c = line[0]
+        if c == "#":
+            continue
+        if c == " " or c == "\t":
+            # Continuation line
+            if curkey is not None and line[1:].strip():
+                content.append(line)
+            continue
+        key, sep, value = line.partition(":")
+        if not sep: continue
+        if curkey is not None:
+            para[curkey] = decode("\n".join(content))
+        curkey = wanted.get(key.rstrip().lower(), None)
+        if curkey is not None:
+            content = [value.strip()]
+    if curkey is not None:
+        para[curkey] = decode("\n".join(content))
+    if para:
+        yield para
+
+def iter_paragraph_spans(fd):
+    """
+    Generate (position, lines) for each paragraph of a deb822 file, where
+    position is the offset of its first line in the file
+    """
+    pos = 0
+    start = None
+    lines = []
+    for line in utils.read_lines(fd):
+        if line.strip():
+            if not lines:
+                start = pos
+            lines.append(line)
+        elif lines:
+            yield start, lines
+            lines = []
+        pos += len(line) + 1
+    if lines:
+        yield start, lines
+
+def paragraph_ranges(fname, count):
+    """
+    Split a file of deb822 paragraphs into about count (start, end) byte
+    ranges, each ending at a paragraph boundary
+    """
+    size = os.path.getsize(fname)
+    res = []
+    start = 0
+    with open(fname, "rb") as fd:
+        for i in xrange(1, count):
+            if start >= size: break
+            pos = max(start, size * i // count)
+            fd.seek(pos)
+            # Skip the rest of the current line
+            if pos > 0: fd.readline()
+            # Move past the next blank line
+            while True:
+                line = fd.readline()
+                if not line or not line.strip(): break
+            end = fd.tell()
+            if end > start:
+                res.append((start, end))
+                start = end
+    if start < size:
+        res.append((start, size))
+    return res
+
+def split_multivalue(value, re_multivalue=re.compile(r'\s*,\s*')):
+    """
+    Split the value of a comma separated field into a list
+    """
+    if not value:
+        return []
+    if "\n" in value:
+        # Folded values keep whitespace at the start of lines
+        return [x for x in re_multivalue.split(value) if x]
+    return [x for x in (x.strip() for x in value.split(",")) if x]
+
 Pkg = collections.namedtuple("Pkg", ("name", "ver", "src", "sec", "sdesc", "ldesc", "archs",
                                      "predeps", "deps", "recs", "suggs", "enhs", "dist"))
 
+class LazyFields(object):
+    """
+    Mixin for subclasses of the namedtuple BASE whose LAZY fields are
+    computed by properties the first time they are used: the tuple itself
+    holds None in their place.
+
+    Instances compare, iterate, search, index and pickle like the BASE tuple
+    with all the fields computed. Only code reading the tuple slots directly,
+    like % string formatting, sees the None: use tuple(obj) there.
+    """
+    BASE = None
+    LAZY = ()
+
+    def _loaded(self):
+        """
+        Return the plain BASE tuple, with the lazy fields computed
+        """
+        values = list(tuple.__iter__(self))
+        for name in self.LAZY:
+            values[self.BASE._fields.index(name)] = getattr(self, name)
+        return self.BASE._make(values)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, int) and self.BASE._fields[idx] not in self.LAZY:
+            return tuple.__getitem__(self, idx)
+        return self._loaded()[idx]
+
+    def __getslice__(self, start, end):
+        return self._loaded()[start:end]
+
+    def __iter__(self):
+        return iter(self._loaded())
+
+    def __contains__(self, value):
+        return value in self._loaded()
+
+    def count(self, value):
+        return self._loaded().count(value)
+
+    def index(self, value, *args):
+        return self._loaded().index(value, *args)
+
+    @staticmethod
+    def _plain(other):
+        return other._loaded() if isinstance(other, LazyFields) else other
+
+    def __eq__(self, other):
+        return self._loaded() == self._plain(other)
+
+    def __ne__(self, other):
+        return self._loaded() != self._plain(other)
+
+    def __lt__(self, other):
+        return self._loaded() < self._plain(other)
+
+    def __le__(self, other):
+        return self._loaded() <= self._plain(other)
+
+    def __gt__(self, other):
+        return self._loaded() > self._plain(other)
+
+    def __ge__(self, other):
+        return self._loaded() >= self._plain(other)
+
+    def __hash__(self):
+        return hash(self._loaded())
+
+    def __repr__(self):
+        return repr(self._loaded())
+
+    def _replace(self, **kw):
+        return self._loaded()._replace(**kw)
+
+    def __reduce__(self):
+        return self.BASE, tuple(self._loaded())
+
+class StoredPkg(LazyFields, Pkg):
+    """
+    Pkg built from a PackageStore, whose long description is read back from
+    the file the first time it is used
+    """
+    BASE = Pkg
+    LAZY = ("ldesc",)
+
+    def __new__(cls, store, pid, *fields):
+        self = Pkg.__new__(cls, *fields)
+        self._store = store
+        self._pid = pid
+        return self
+
+    @property
+    def ldesc(self):
+        res = self.__dict__.get("_ldesc", None)
+        if res is None:
+            res = self._ldesc = self._store.ldesc(self._pid)
+        return res
+
+class PackageStore(object):
+    """
+    Compact, columnar storage of the Pkg records of a BinPackages file.
+
+    Strings are interned and referenced by integer ID, lists are stored as
+    arrays of string IDs, and long descriptions are read back from the file
+    only when a StoredPkg needs them.
+    """
+    LIST_FIELDS = ("archs", "predeps", "deps", "recs", "suggs", "enhs", "dist")
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.fd = None
+        self.strings = []
+        self.string_ids = dict()
+        # Package names, by record ID
+        self.names = []
+        # Name -> ID of its last record
+        self.index = dict()
+        # Section name -> array of record IDs
+        self.sections = dict()
+        # String IDs of single valued fields
+        self.ver = array.array("I")
+        self.src = array.array("I")
+        self.sec = array.array("I")
+        self.sdesc = array.array("I")
+        # Position and size of the record in the file
+        self.pos = array.array("L")
+        self.size = array.array("I")
+        # Field -> (array of string IDs, array of end positions in it)
+        self.lists = dict((f, (array.array("I"), array.array("I"))) for f in self.LIST_FIELDS)
+
+    def intern(self, s):
+        sid = self.string_ids.get(s, None)
+        if sid is None:
+            sid = self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return sid
+
+    def add(self, info, pos, size):
+        """
+        Add a Pkg, read from the record at the given position of the file
+        """
+        pid = len(self.names)
+        self.names.append(info.name)
+        self.index[info.name] = pid
+        self.sections.setdefault(info.sec, array.array("I")).append(pid)
+        self.ver.append(self.intern(info.ver))
+        self.src.append(self.intern(info.src))
+        self.sec.append(self.intern(info.sec))
+        self.sdesc.append(self.intern(info.sdesc))
+        self.pos.append(pos)
+        self.size.append(size)
+        for f in self.LIST_FIELDS:
+            ids, ends = self.lists[f]
+            ids.extend(self.intern(x) for x in getattr(info, f))
+            ends.append(len(ids))
+
+    def ldesc(self, pid):
+        """
+        Read the long description of a record from the file
+        """
+        if self.fd is None:
+            self.fd = open(self.fname, "r")
+        self.fd.seek(self.pos[pid])
+        lines = self.fd.read(self.size[pid]).split("\n")
+        for para in parse_paragraphs(lines, ("Description",)):
+            return utils.splitdesc(para["Description"])[1]
+        return ""
+
+    def pkg(self, pid):
+        """
+        Build the StoredPkg for a record
+        """
+        strings = self.strings
+        lists = []
+        for f in self.LIST_FIELDS:
+            ids, ends = self.lists[f]
+            start = ends[pid - 1] if pid else 0
+            lists.append([strings[x] for x in ids[start:ends[pid]]])
+        return StoredPkg(self, pid, self.names[pid], strings[self.ver[pid]], strings[self.src[pid]],
+                         strings[self.sec[pid]], strings[self.sdesc[pid]], None, *lists)
+
+class StoreByName(collections.Mapping):
+    """
+    Read-only name -> Pkg mapping over a PackageStore
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, name):
+        return self.store.pkg(self.store.index[name])
+
+    def __contains__(self, name):
+        return name in self.store.index
+
+    def __iter__(self):
+        return iter(self.store.index)
+
+    def __len__(self):
+        return len(self.store.index)
+
+class StoreBySection(collections.Mapping):
+    """
+    Read-only section -> list of Pkg mapping over a PackageStore
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, section):
+        return [self.store.pkg(pid) for pid in self.store.sections[section]]
+
+    def __contains__(self, section):
+        return section in self.store.sections
+
+    def __iter__(self):
+        return iter(self.store.sections)
+
+    def __len__(self):
+        return len(self.store.sections)
+
 class BinPackages(DataSource):
     """
     Binary package information
     """
     FILENAME = "all-merged"
 
-    def load(self, **kw):
-        re_multivalue = re.compile(r'\s*,\s*')
+    FIELDS = ("Package", "Version", "Source", "Section", "Description", "Architecture",
+              "Pre-Depends", "Depends", "Recommends", "Suggests", "Enhances", "Distribution")
+
+    def load(self, workers=None, compact=False, **kw):
+        """
+        Load the package information.
+
+        If workers is more than 1, the file is parsed in chunks by that many
+        worker processes.
+
+        If compact is True, packages are kept in a PackageStore, and by_name
+        and by_section become read-only views that build Pkg tuples on
+        access. The file is then parsed sequentially.
+        """
+        log.info("Loading %s...", self.datafile)
+        # Drop the dependency graph of a previous load
+        self.__dict__.pop("depgraph", None)
+        if compact:
+            self.store = PackageStore(self.datafile)
+            with open(self.datafile, "r") as fd:
+                for start, lines in iter_paragraph_spans(fd):
+                    for para in parse_paragraphs(lines, self.FIELDS):
+                        info = self.cook(para)
+                        if info is not None:
+                            self.store.add(info, start, sum(len(l) + 1 for l in lines))
+            self.by_name = StoreByName(self.store)
+            self.by_section = StoreBySection(self.store)
+            return
 
+        self.store = None
         self.by_name = dict()
         self.by_section = dict()
+        if workers is not None and workers > 1:
+            self._index(self._parse_parallel(workers))
+        else:
+            with open(self.datafile, "r") as fd:
+                self._index(self.parse(utils.read_lines(fd)))
 
-        log.info("Loading %s...", self.datafile)
-        with open(self.datafile, "r") as fd:
-            for pkg in deb822.Deb822.iter_paragraphs(fd):
-                name = pkg["Package"]
-                src = pkg.get("Source", name)
-                if not src: src = name
+    @utils.lazy_property
+    def depgraph(self):
+        """
+        Dependency graph of the packages, built on first use
+        """
+        return depgraph.DepGraph(self)
 
-                section = pkg.get("Section", "unknown")
-                section = section.split("/")[-1]
+    def _index(self, pkgs):
+        for info in pkgs:
+            # Index it by various attributes
+            self.by_name[info.name] = info
+            self.by_section.setdefault(info.sec, []).append(info)
+
+    def _parse_parallel(self, workers):
+        """
+        Parse the file in a pool of worker processes, generating Pkg tuples
+        in file order
+        """
+        # Use more chunks than workers, to even out the load
+        ranges = paragraph_ranges(self.datafile, workers * 4)
+        pool = multiprocessing.Pool(workers)
+        try:
+            for pkgs in pool.imap(_parse_binpackages_range, [(self.datafile, start, end) for start, end in ranges]):
+                for info in pkgs:
+                    yield info
+        finally:
+            pool.terminate()
+            pool.join()
 
-                desc = pkg.get("Description", None)
-                if desc is None: continue
-                sdesc, ldesc = utils.splitdesc(desc)
+    @classmethod
+    def parse(cls, lines):
+        """
+        Parse the given lines of package records, generating Pkg tuples
+        """
+        for pkg in parse_paragraphs(lines, cls.FIELDS):
+            info = cls.cook(pkg)
+            if info is not None:
+                yield info
+
+    @staticmethod
+    def cook(pkg):
+        """
+        Make a Pkg out of the fields of a package record, or return None if
+        the record should be skipped
+        """
+        name = pkg["Package"]
+        src = pkg.get("Source", name)
+        if not src: src = name
 
-                def mv(name):
-                    "Get list value for multivalue field"
-                    return [x for x in re_multivalue.split(pkg.get(name, "")) if x]
+        section = pkg.get("Section", "unknown")
+        section = section.split("/")[-1]
 
-                # Cook the source info and make a dict with what we need
-                info = Pkg(name, pkg["Version"], src, section, sdesc, ldesc,
-                           mv("Architecture"), mv("Pre-Depends"), mv("Depends"),
-                           mv("Recommends"), mv("Suggests"), mv("Enhances"), mv("Distribution"))
+        desc = pkg.get("Description", None)
+        if desc is None: return None
+        sdesc, ldesc = utils.splitdesc(desc)
 
-                # Index it by various attributes
-                self.by_name[name] = info
-                self.by_section.setdefault(section, []).append(info)
+        mv = lambda name: split_multivalue(pkg.get(name, None))
+
+        # Cook the source info and make a dict with what we need
+        return Pkg(name, pkg["Version"], src, section, sdesc, ldesc,
+                   mv("Architecture"), mv("Pre-Depends"), mv("Depends"),
+                   mv("Recommends"), mv("Suggests"), mv("Enhances"), mv("Distribution"))
+
+def _parse_binpackages_range(args):
+    """
+    Parse a byte range of a BinPackages file, in a worker process
+    """
+    fname, start, end = args
+    with open(fname, "r") as fd:
+        fd.seek(start)
+        return list(BinPackages.parse(utils.read_lines(fd, size=end - start)))
 
 Src = collections.namedtuple("Src", ("name", "ver", "maint", "upls", "bd", "bdi"))
 
+class RawSrc(LazyFields, Src):
+    """
+    Src that keeps maintainer and uploaders as the raw field values, and
+    parses them into (name, email) pairs the first time they are used
+    """
+    BASE = Src
+    LAZY = ("maint", "upls")
+
+    def __new__(cls, name, ver, maint, upls, bd, bdi):
+        self = Src.__new__(cls, name, ver, None, None, bd, bdi)
+        self._raw_maint = maint
+        self._raw_upls = upls
+        return self
+
+    @property
+    def maint(self):
+        res = self.__dict__.get("_maint", None)
+        if res is None:
+            res = self._maint = rfc822.parseaddr(self._raw_maint or "")
+        return res
+
+    @property
+    def upls(self):
+        res = self.__dict__.get("_upls", None)
+        if res is None:
+            if self._raw_upls:
+                res = list(rfc822.AddressList(self._raw_upls))
+            else:
+                res = []
+            self._upls = res
+        return res
+
 class SrcPackages(DataSource):
     """
     Source package information
     """
     FILENAME = "all-merged-sources"
 
+    FIELDS = ("Package", "Version", "Maintainer", "Uploaders",
+              "Build-Depends", "Build-Depends-Indep")
+
     def load(self, **kw):
         # Do nothing here: we load on demand
-        pass
+        self.offsets = None
 
     def sources(self):
         log.info("Loading %s...", self.datafile)
-        re_multivalue = re.compile(r'\s*,\s*')
         with open(self.datafile, "r") as fd:
-            for src in deb822.Deb822.iter_paragraphs(fd):
-                name = src["Package"]
-                mname, memail = rfc822.parseaddr(src.get("Maintainer", ""))
+            for src in parse_paragraphs(utils.read_lines(fd), self.FIELDS):
+                yield self.cook(src)
 
-                uploaders = src.get("Uploaders", None)
-                if uploaders is not None:
-                    uploaders = list(rfc822.AddressList(uploaders))
-                else:
-                    uploaders = []
+    def get(self, name, default=None):
+        """
+        Return the Src for the source package name, reading only its record
+        """
+        res = self.get_many((name,))
+        return res.get(name, default)
+
+    def get_many(self, names):
+        """
+        Return a dict with the Src of those of the given source package names
+        that exist, reading only their records
+        """
+        index = self.index()
+        wanted = []
+        for name in names:
+            pos = index.get(name, None)
+            if pos is not None:
+                wanted.append((pos, name))
+        # Read in file order, to avoid seeking back and forth
+        wanted.sort()
+
+        res = dict()
+        with open(self.datafile, "r") as fd:
+            for (start, size), name in wanted:
+                fd.seek(start)
+                lines = fd.read(size).split("\n")
+                for src in parse_paragraphs(lines, self.FIELDS):
+                    res[name] = self.cook(src)
+        return res
+
+    def index(self):
+        """
+        Return a dict mapping source package names to the (offset, size) of
+        their record in the data file. If a name appears more than once, the
+        last record is used.
+
+        The index is built on first use and saved in datafile + ".index",
+        where it is reused until the data file changes.
+        """
+        if getattr(self, "offsets", None) is None:
+            fname = self.datafile + ".index"
+            self.offsets = read_offset_index(fname, self.datafile)
+            if self.offsets is None:
+                log.info("Indexing %s...", self.datafile)
+                self.offsets = dict()
+                with open(self.datafile, "r") as fd:
+                    for start, lines in iter_paragraph_spans(fd):
+                        for src in parse_paragraphs(lines, ("Package",)):
+                            self.offsets[src["Package"]] = (start, sum(len(l) + 1 for l in lines))
+                try:
+                    write_offset_index(fname, self.datafile, self.offsets)
+                except (IOError, OSError) as e:
+                    log.warning("Cannot write index %s: %s", fname, e)
+        return self.offsets
 
-                def mv(name):
-                    "Get list value for multivalue field"
-                    return [x for x in re_multivalue.split(src.get(name, "")) if x]
+    @staticmethod
+    def cook(src):
+        """
+        Make a Src out of the fields of a source record
+        """
+        mv = lambda name: split_multivalue(src.get(name, None))
+        return RawSrc(src["Package"], src["Version"], src.get("Maintainer", ""),
+                   src.get("Uploaders", None), mv("Build-Depends"), mv("Build-Depends-Indep"))
+
+class SourceJoin(object):
+    """
+    Join binary packages with the source packages they are built from
+    """
+    def __init__(self, binpackages, srcpackages):
+        self.binpackages = binpackages
+        self.srcpackages = srcpackages
+        self._binaries = None
+
+    @property
+    def binaries(self):
+        """
+        Dict mapping source package names to the names of their binary
+        packages, built on first use
+        """
+        if self._binaries is None:
+            self._binaries = dict()
+            for pkg in self.binpackages.by_name.itervalues():
+                # Source can be "name (version)"
+                src = pkg.src.split(None, 1)[0]
+                self._binaries.setdefault(src, []).append(pkg.name)
+        return self._binaries
 
-                yield Src(name, src["Version"], (mname, memail), uploaders,
-                          mv("Build-Depends"), mv("Build-Depends-Indep"))
+    def groups(self, sources=None):
+        """
+        Generate (Src, [Pkg]) for each source package that has binary
+        packages.
 
+        Source packages are streamed from sources, by default
+        srcpackages.sources(), so only the src -> binary names index is kept
+        in memory.
+        """
+        if sources is None:
+            sources = self.srcpackages.sources()
+        by_name = self.binpackages.by_name
+        binaries = self.binaries
+        for src in sources:
+            names = binaries.get(src.name, None)
+            if names:
+                yield src, [by_name[n] for n in names]
+
+    def maintainer_groups(self, emails, uploaders=False):
+        """
+        Generate (Src, [Pkg]) for the source packages maintained by any of
+        the given email addresses, and optionally also those they upload
+        """
+        emails = frozenset(e.lower() for e in emails)
+        for src, pkgs in self.groups():
+            if emails.intersection(self._emails(src, uploaders)):
+                yield src, pkgs
+
+    def by_maintainer(self, uploaders=False):
+        """
+        Return a dict mapping maintainer email addresses to the set of names
+        of the binary packages they maintain, and optionally upload.
+
+        The sets can be used as package whitelists for per-team autotag runs.
+        """
+        res = dict()
+        for src, pkgs in self.groups():
+            names = [p.name for p in pkgs]
+            for email in self._emails(src, uploaders):
+                res.setdefault(email, set()).update(names)
+        return res
+
+    @staticmethod
+    def _emails(src, uploaders):
+        res = set()
+        if src.maint[1]:
+            res.add(src.maint[1].lower())
+        if uploaders:
+            res.update(email.lower() for name, email in src.upls if email)
+        return res
+
+INDEX_VERSION = 1
+
+def read_offset_index(fname, source):
+    """
+    Load the offset index fname built from the deb822 file source, or return
+    None if it is missing or out of date
+    """
+    try:
+        with open(fname, "rb") as fd:
+            data = marshal.load(fd)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get("version", None) != INDEX_VERSION:
+        return None
+    if utils.unchanged_file_key(source, data["size"], data["mtime"], data["hash"]) is None:
+        return None
+    offsets = array.array("L", data["offsets"])
+    sizes = array.array("I", data["sizes"])
+    return dict(zip(data["names"], zip(offsets, sizes)))
+
+def write_offset_index(fname, source, index):
+    """
+    Write the offset index of the deb822 file source
+    """
+    names = index.keys()
+    offsets = array.array("L", (index[n][0] for n in names))
+    sizes = array.array("I", (index[n][1] for n in names))
+    size, mtime = utils.file_key(source)
+    data = dict(
+        version=INDEX_VERSION,
+        size=size,
+        mtime=mtime,
+        hash=utils.file_fingerprint(source),
+        names=names,
+        offsets=offsets.tostring(),
+        sizes=sizes.tostring(),
+    )
+    with utils.atomic_writer(fname, sync=False) as fd:
+        fd.write(marshal.dumps(data, 2))
 
 Facet = collections.namedtuple("Facet", ("name", "sdesc", "ldesc"))
 Tag = collections.namedtuple("Tag", ("name", "facet", "sdesc", "ldesc"))
@@ -130,6 +800,10 @@ class Vocabulary(DataSource):
                 else:
                     log.warning("Found a record in vocabulary that is neither a Facet nor a Tag")
 
+    def after_load(self):
+        # Give the tags of the vocabulary the lowest IDs
+        tagids.interner.seed(self)
+
 class Popcon(DataSource):
     """
     Popcon votes
@@ -157,11 +831,46 @@ class StableTags(DataSource):
     """
     FILENAME = "tags-stable"
 
-    def load(self, **kw):
-        self.db = debtags.DB()
+    def load(self, snapshot=False, snapshot_dir=None, bitset=False, **kw):
+        """
+        Load the tag database, using a snapshot if snapshot is True. The
+        snapshot is kept in snapshot_dir, or next to the data file by
+        default.
+
+        If bitset is True, the database is a read-only bitsetdb.BitsetDB
+        instead of a debtags.DB. It is built in after_load, so that tag IDs
+        are allocated in the main process, after the vocabulary tags.
+        """
         log.info("Loading %s...", self.datafile)
-        with open(self.datafile, "r") as fd:
-            self.db.read(fd)
+        self.__dict__.pop("db", None)
+        self.tag_arrays = None
+        if bitset:
+            if snapshot:
+                self.tag_arrays = tagsnapshot.read_tag_arrays(self.datafile, snapshot_dir=snapshot_dir)
+            else:
+                db = debtags.DB()
+                with open(self.datafile, "r") as fd:
+                    db.read(fd)
+                self.tag_arrays = tagsnapshot.encode(db)
+        elif snapshot:
+            self.db = tagsnapshot.read_tags(self.datafile, snapshot_dir=snapshot_dir)
+        else:
+            self.db = debtags.DB()
+            with open(self.datafile, "r") as fd:
+                self.db.read(fd)
+
+    @utils.lazy_property
+    def db(self):
+        """
+        BitsetDB of a load with bitset=True, built from the tag arrays read
+        by load
+        """
+        arrays, self.tag_arrays = self.tag_arrays, None
+        return bitsetdb.BitsetDB.from_arrays(*arrays)
+
+    def after_load(self):
+        if self.tag_arrays is not None:
+            self.db
 
 class UnstableTags(StableTags):
     """
@@ -179,6 +888,7 @@ class Sources(dict):
         Instantiate those sources for which we have data files
         """
         self.sources = []
+        self.timings = dict()
         for cls in BinPackages, SrcPackages, Vocabulary, Popcon, StableTags, UnstableTags:
             src = cls.create(datadir, **kw)
             if src is not None:
@@ -197,12 +907,134 @@ class Sources(dict):
         else:
             self.sources.append(src)
 
-    def load(self, **kw):
+    def load(self, concurrency=None, **kw):
+        """
+        Load data sources.
+
+        concurrency can be None to load one source after the other,
+        "threads" to load each source in its own thread, or "processes" to
+        load each source in its own process and send the loaded data back.
+
+        Returns a dict with the time in seconds it took to load each source,
+        which is also stored in self.timings.
+        """
+        self.timings = self._load(self.named_sources(), concurrency, kw)
+        return self.timings
+
+    def reload(self, actions=(), concurrency=None, **kw):
+        """
+        Reload only the data sources whose data file changed since they
+        were last loaded.
+
+        actions is a sequence of Action classes or instances. Returns the
+        list of names of the reloaded sources, and the list of those actions
+        that need any of them.
+        """
+        named = [(name, src) for name, src in self.named_sources() if src.changed()]
+        self.timings.update(self._load(named, concurrency, kw))
+        changed = frozenset(name for name, src in named)
+        affected = [a for a in actions if changed.intersection(a.NEED_SOURCES)]
+        return [name for name, src in named], affected
+
+    def _load(self, named, concurrency, kw):
+        if concurrency is None:
+            timings = dict()
+            for name, src in named:
+                timings[name] = _load_source(src, kw)
+        elif concurrency == "threads":
+            timings = self._load_threads(named, kw)
+        elif concurrency == "processes":
+            timings = self._load_processes(named, kw)
+        else:
+            raise ValueError("Unsupported concurrency %r" % (concurrency,))
+
+        for name, src in named:
+            src.after_load()
+
+        for name, elapsed in sorted(timings.iteritems()):
+            log.info("Loaded %s in %.3fs", name, elapsed)
+        return timings
+
+    def named_sources(self):
         """
-        Load data sources
+        Return (name, source) pairs in loading order
         """
-        for src in self.sources:
-            src.load(**kw)
+        names = dict((id(src), name) for name, src in self.iteritems())
+        return [(names[id(src)], src) for src in self.sources]
+
+    def _load_threads(self, named, kw):
+        timings = dict()
+        errors = []
+        def load(name, src):
+            try:
+                timings[name] = _load_source(src, kw)
+            except Exception:
+                errors.append(sys.exc_info())
+        threads = [threading.Thread(target=load, args=x) for x in named]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        if errors:
+            exc_type, exc_value, exc_tb = errors[0]
+            raise exc_type, exc_value, exc_tb
+        return timings
+
+    def _load_processes(self, named, kw):
+        # Use a process per source, rather than a Pool, so that sources can
+        # use worker processes themselves
+        children = []
+        for name, src in named:
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(target=_load_source_child, args=(child_conn, src, kw))
+            proc.start()
+            child_conn.close()
+            children.append((name, src, parent_conn, proc))
+
+        timings = dict()
+        failed = []
+        for name, src, conn, proc in children:
+            try:
+                ok, res, elapsed = conn.recv()
+            except EOFError:
+                ok, res, elapsed = False, "worker process died", None
+            conn.close()
+            proc.join()
+            if ok:
+                # Replace the whole state, so that nothing cached from a
+                # previous load survives
+                src.__dict__.clear()
+                src.__dict__.update(res)
+                timings[name] = elapsed
+            else:
+                failed.append("%s: %s" % (name, res))
+        if failed:
+            raise RuntimeError("Cannot load data sources: %s" % "; ".join(failed))
+        return timings
+
+def _load_source(src, kw):
+    """
+    Load a data source, returning the time it took.
+
+    The fingerprint of the data file is taken before loading, so that
+    changes made while loading are picked up by the next reload.
+    """
+    start = time.time()
+    fingerprint = src.fingerprint()
+    src.load(**kw)
+    src.loaded_fingerprint = fingerprint
+    return time.time() - start
+
+def _load_source_child(conn, src, kw):
+    """
+    Load a data source in a child process, sending back its state
+    """
+    try:
+        elapsed = _load_source(src, kw)
+        # Connection.send pickles with the highest protocol
+        conn.send((True, src.__dict__, elapsed))
+    except Exception:
+        conn.send((False, traceback.format_exc(), None))
+    finally:
+        conn.close()
 
 class Action(object):
     def __init__(self, sources, **kw):
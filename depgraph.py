@@ -0,0 +1,417 @@
+import re
+import array
+import logging
+import bitsetdb
+
+log = logging.getLogger(__name__)
+
+# Pkg fields with package relations, in the order used for field IDs
+FIELDS = ("predeps", "deps", "recs", "suggs", "enhs")
+
+re_relation = re.compile(r"""
+    ^\s*(?P<name>[^\s:(\[<|]+)      # Package name
+    (?::[^\s(\[<|]+)?               # Architecture qualifier
+    \s*(?:\(\s*(?P<op><<|<=|>=|>>|=|<|>)\s*(?P<ver>[^)\s]+)\s*\))?
+""", re.VERBOSE)
+
+def parse_relation(relation):
+    """
+    Parse one relation, like "libgtk2.0-0 (>= 2.24) | libgtk3", into a
+    list of (name, constraint) for each alternative, where constraint is
+    None or an (operator, version) pair
+    """
+    res = []
+    for alt in relation.split("|"):
+        mo = re_relation.match(alt)
+        if mo is None:
+            continue
+        op = mo.group("op")
+        res.append((mo.group("name"), (op, mo.group("ver")) if op else None))
+    return res
+
+class DepGraph(object):
+    """
+    Dependency graph of binary packages.
+
+    Every package name, including names of virtual or missing packages
+    that are only depended upon, has an integer ID; real packages come
+    first, with IDs below self.real. Edges go from a package to each
+    alternative of each of its relations, and are stored in compact arrays
+    both by depending package (forward) and by target (reverse).
+    """
+    def __init__(self, binpackages, fields=FIELDS):
+        self.fields = tuple(fields)
+        self.names = []
+        self.ids = dict()
+
+        pkgs = binpackages.by_name.values()
+        for pkg in pkgs:
+            self._alloc(pkg.name)
+        self.real = len(self.names)
+
+        # Edges, sorted by source package
+        self.edge_target = array.array("I")
+        self.edge_field = array.array("B")
+        # Position in the list of alternatives of the relation
+        self.edge_alt = array.array("B")
+        # Index in self.constraints, or 0 for no constraint
+        self.edge_constraint = array.array("I")
+        self.fwd_offsets = array.array("I", [0])
+
+        self.constraints = [None]
+        constraint_ids = {None: 0}
+        # The same relation strings are used over and over
+        parsed = dict()
+        for pkg in pkgs:
+            for field_id, field in enumerate(self.fields):
+                for relation in getattr(pkg, field):
+                    alts = parsed.get(relation, None)
+                    if alts is None:
+                        alts = []
+                        for name, constraint in parse_relation(relation):
+                            cid = constraint_ids.get(constraint, None)
+                            if cid is None:
+                                cid = constraint_ids[constraint] = len(self.constraints)
+                                self.constraints.append(constraint)
+                            alts.append((self._alloc(name), cid))
+                        parsed[relation] = alts
+                    for alt, (target, cid) in enumerate(alts):
+                        self.edge_target.append(target)
+                        self.edge_field.append(field_id)
+                        self.edge_alt.append(min(alt, 255))
+                        self.edge_constraint.append(cid)
+            self.fwd_offsets.append(len(self.edge_target))
+
+        self._build_reverse()
+        log.info("Dependency graph: %d packages, %d names, %d edges",
+                 self.real, len(self.names), len(self.edge_target))
+
+    def _build_reverse(self):
+        """
+        Sort edge indices by target, with a counting sort
+        """
+        count = len(self.names)
+        offsets = [0] * (count + 1)
+        for target in self.edge_target:
+            offsets[target + 1] += 1
+        for i in xrange(count):
+            offsets[i + 1] += offsets[i]
+        self.rev_offsets = array.array("I", offsets)
+
+        pos = offsets[:-1]
+        rev_edges = [0] * len(self.edge_target)
+        rev_sources = [0] * len(self.edge_target)
+        offs = self.fwd_offsets
+        for src in xrange(self.real):
+            for edge in xrange(offs[src], offs[src + 1]):
+                target = self.edge_target[edge]
+                rev_edges[pos[target]] = edge
+                rev_sources[pos[target]] = src
+                pos[target] += 1
+        self.rev_edges = array.array("I", rev_edges)
+        self.rev_sources = array.array("I", rev_sources)
+
+    def _alloc(self, name):
+        """
+        Return the ID of a package name, allocating it if needed
+        """
+        res = self.ids.get(name, None)
+        if res is None:
+            res = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return res
+
+    def id(self, name):
+        """
+        Return the ID of a package name, or None if it is not in the graph
+        """
+        return self.ids.get(name, None)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.ids
+
+    def _edge_filter(self, fields, first_only):
+        if fields is None:
+            field_ids = None
+        else:
+            field_ids = frozenset(self.fields.index(f) for f in fields)
+        def accept(edge):
+            if first_only and self.edge_alt[edge]:
+                return False
+            if field_ids is not None and self.edge_field[edge] not in field_ids:
+                return False
+            return True
+        return accept
+
+    def forward(self, pid, fields=None, first_only=False):
+        """
+        Generate the IDs of the packages pid depends on.
+
+        fields restricts the relations to the given Pkg fields, and if
+        first_only is True, only the first alternative of each relation is
+        used.
+        """
+        if pid >= self.real: return
+        accept = self._edge_filter(fields, first_only)
+        for edge in xrange(self.fwd_offsets[pid], self.fwd_offsets[pid + 1]):
+            if accept(edge):
+                yield self.edge_target[edge]
+
+    def reverse(self, pid, fields=None, first_only=False):
+        """
+        Generate the IDs of the packages that depend on pid, with the same
+        filters as forward()
+        """
+        accept = self._edge_filter(fields, first_only)
+        for i in xrange(self.rev_offsets[pid], self.rev_offsets[pid + 1]):
+            if accept(self.rev_edges[i]):
+                yield self.rev_sources[i]
+
+    def edges(self, pid):
+        """
+        Generate (target name, field, alternative index, constraint) for the
+        relations of pid
+        """
+        if pid >= self.real: return
+        for edge in xrange(self.fwd_offsets[pid], self.fwd_offsets[pid + 1]):
+            yield (self.names[self.edge_target[edge]], self.fields[self.edge_field[edge]],
+                   self.edge_alt[edge], self.constraints[self.edge_constraint[edge]])
+
+    def depends(self, name, **kw):
+        """
+        Return the sorted names of the packages name depends on
+        """
+        pid = self.ids.get(name, None)
+        if pid is None: return []
+        return sorted(set(self.names[x] for x in self.forward(pid, **kw)))
+
+    def rdepends(self, name, **kw):
+        """
+        Return the sorted names of the packages that depend on name
+        """
+        pid = self.ids.get(name, None)
+        if pid is None: return []
+        return sorted(set(self.names[x] for x in self.reverse(pid, **kw)))
+
+    def closure(self, fields=("predeps", "deps"), first_only=False):
+        """
+        Return the Closure of the graph restricted to the given fields and
+        alternatives, building it on first use
+        """
+        key = (tuple(fields), first_only)
+        cache = self.__dict__.setdefault("_closures", dict())
+        res = cache.get(key, None)
+        if res is None:
+            res = cache[key] = Closure(self, fields, first_only)
+        return res
+
+class Closure(object):
+    """
+    Transitive dependencies over a DepGraph.
+
+    Strongly connected components of the graph are collapsed, and results
+    are memoised per component. The closure of a package is the set of
+    packages it depends on through one or more relations, and does not
+    include the package itself.
+    """
+    def __init__(self, graph, fields=("predeps", "deps"), first_only=False):
+        self.graph = graph
+        self.adj = [tuple(set(graph.forward(pid, fields=fields, first_only=first_only)))
+                    for pid in xrange(len(graph))]
+        self._find_components()
+        # Component -> bitset of the packages in the components it reaches
+        self._down = dict()
+        # Predicate -> list of booleans by component
+        self._reaches = dict()
+        log.info("Dependency closure: %d packages in %d components", len(self.adj), len(self.members))
+
+    def _find_components(self):
+        """
+        Find strongly connected components with an iterative version of
+        Tarjan's algorithm. Components are numbered in reverse topological
+        order: dependencies come before the packages that depend on them.
+        """
+        adj = self.adj
+        count = len(adj)
+        index = [-1] * count
+        low = [0] * count
+        on_stack = [False] * count
+        stack = []
+        self.component = array.array("I", [0] * count)
+        self.members = []
+        next_index = 0
+        for root in xrange(count):
+            if index[root] != -1: continue
+            index[root] = low[root] = next_index
+            next_index += 1
+            stack.append(root)
+            on_stack[root] = True
+            work = [(root, 0)]
+            while work:
+                node, pos = work[-1]
+                succ = adj[node]
+                if pos < len(succ):
+                    work[-1] = (node, pos + 1)
+                    child = succ[pos]
+                    if index[child] == -1:
+                        index[child] = low[child] = next_index
+                        next_index += 1
+                        stack.append(child)
+                        on_stack[child] = True
+                        work.append((child, 0))
+                    elif on_stack[child] and index[child] < low[node]:
+                        low[node] = index[child]
+                    continue
+                work.pop()
+                if work and low[node] < low[work[-1][0]]:
+                    low[work[-1][0]] = low[node]
+                if low[node] == index[node]:
+                    cid = len(self.members)
+                    members = []
+                    while True:
+                        x = stack.pop()
+                        on_stack[x] = False
+                        self.component[x] = cid
+                        members.append(x)
+                        if x == node: break
+                    self.members.append(tuple(members))
+
+    def _successors(self, cid):
+        """
+        Return the components directly reachable from component cid
+        """
+        component = self.component
+        res = set()
+        for pid in self.members[cid]:
+            for x in self.adj[pid]:
+                res.add(component[x])
+        res.discard(cid)
+        return res
+
+    def _down_bits(self, cid):
+        """
+        Return the bitset of the components reachable from component cid,
+        other than cid itself
+        """
+        down = self._down
+        if cid in down:
+            return down[cid]
+        # Depth first, computing a component once all its successors are
+        # done
+        work = [cid]
+        while work:
+            c = work[-1]
+            if c in down:
+                work.pop()
+                continue
+            succ = self._successors(c)
+            missing = [s for s in succ if s not in down]
+            if missing:
+                work.extend(missing)
+                continue
+            work.pop()
+            bits = 0
+            for s in succ:
+                bits |= down[s] | (1 << s)
+            down[c] = bits
+        return down[cid]
+
+    def reachable(self, name, max_depth=None):
+        """
+        Return the set of names of the packages that name transitively
+        depends on, through at most max_depth relations if given
+        """
+        pid = self.graph.id(name)
+        if pid is None: return set()
+        names = self.graph.names
+        if max_depth is not None:
+            return set(names[x] for x in self._bfs(pid, max_depth))
+
+        cid = self.component[pid]
+        res = set()
+        for down in bitsetdb.ids_of_bits(self._down_bits(cid)):
+            res.update(names[x] for x in self.members[down])
+        if len(self.members[cid]) > 1 or pid in self.adj[pid]:
+            res.update(names[x] for x in self.members[cid])
+        return res
+
+    def _bfs(self, pid, max_depth):
+        """
+        Generate the IDs of the packages reachable from pid in at most
+        max_depth steps
+        """
+        seen = set((pid,))
+        level = [pid]
+        for depth in xrange(max_depth):
+            following = []
+            for node in level:
+                for x in self.adj[node]:
+                    if x == pid:
+                        yield x
+                    if x in seen: continue
+                    seen.add(x)
+                    following.append(x)
+                    yield x
+            if not following: break
+            level = following
+
+    def _matching_components(self, predicate):
+        """
+        Return a list telling, for each component, if anything reachable
+        from it (other than itself) matches predicate, and a list telling,
+        for each package, if its name matches predicate
+        """
+        cached = self._reaches.get(predicate, None)
+        if cached is not None:
+            return cached
+        names = self.graph.names
+        matches = [bool(predicate(n)) for n in names]
+        res = [False] * len(self.members)
+        # Components are in reverse topological order, so successors are
+        # always done first
+        for cid in xrange(len(self.members)):
+            for s in self._successors(cid):
+                if res[s] or any(matches[x] for x in self.members[s]):
+                    res[cid] = True
+                    break
+        self._reaches[predicate] = (res, matches)
+        return res, matches
+
+    def depends_on(self, name, predicate, max_depth=None):
+        """
+        Check if name transitively depends on a package whose name matches
+        predicate, through at most max_depth relations if given.
+
+        predicate is a function taking a package name; results are memoised
+        for each predicate, so reuse the same function object across calls.
+        """
+        pid = self.graph.id(name)
+        if pid is None: return False
+        if max_depth is not None:
+            names = self.graph.names
+            for x in self._bfs(pid, max_depth):
+                if predicate(names[x]):
+                    return True
+            return False
+
+        reaches, matches = self._matching_components(predicate)
+        cid = self.component[pid]
+        if reaches[cid]:
+            return True
+        members = self.members[cid]
+        if len(members) > 1:
+            return any(matches[x] for x in members)
+        return pid in self.adj[pid] and matches[pid]
+
+    def packages_depending_on(self, predicate):
+        """
+        Generate the names of the real packages that transitively depend on
+        a package whose name matches predicate
+        """
+        names = self.graph.names
+        for pid in xrange(self.graph.real):
+            if self.depends_on(names[pid], predicate):
+                yield names[pid]
@@ -1,32 +1,113 @@
 import utils
 import itertools
+import collections
+import operator
 import re
+import os
+import bisect
+import heapq
+import marshal
+import array
+import zlib
+import bz2
+import sys
+
+# Identical tag sets are shared by all patches. Each set is both key and
+# value, so the table costs no copies; sets no patch uses anymore are
+# dropped by prune_tagsets, which runs each time the table doubles in size
+_tagsets = dict()
+_tagsets_prune_at = 1024
+
+# References to a set in _tagsets held by the table and by prune_tagsets
+# itself: sets with no more than these are not used anywhere else
+_TAGSETS_OWN_REFS = 4
+
+def intern_tags(tags):
+    """
+    Return a frozenset with the given tags, shared with all other patches
+    that have the same tags
+    """
+    global _tagsets_prune_at
+    tags = frozenset(tags)
+    if not tags:
+        # The empty frozenset is a singleton already
+        return tags
+    res = _tagsets.get(tags, None)
+    if res is None:
+        if len(_tagsets) >= _tagsets_prune_at:
+            prune_tagsets()
+            _tagsets_prune_at = max(1024, len(_tagsets) * 2)
+        res = _tagsets[tags] = tags
+    return res
+
+def prune_tagsets():
+    """
+    Drop the shared tag sets that are not used anymore
+    """
+    # Key and value, the loop variable and the getrefcount argument
+    unused = [s for s in _tagsets if sys.getrefcount(s) <= _TAGSETS_OWN_REFS]
+    for s in unused:
+        del _tagsets[s]
 
 class Patch(object):
     """
-    A patch to the tagset of a package
+    A patch to the tagset of a package.
+
+    added and removed are shared frozensets: assign new sets to change
+    them.
     """
+    __slots__ = ("_added", "_removed")
+
     def __init__(self, text=None, blacklist_tags=[]):
-        self.added = set()
-        self.removed = set()
+        self._added = self._removed = frozenset()
         if text is not None:
             self.parse(text, blacklist_tags=blacklist_tags)
 
+    def __getstate__(self):
+        return self._added, self._removed
+
+    def __setstate__(self, state):
+        self.added, self.removed = state
+
+    @property
+    def added(self):
+        return self._added
+
+    @added.setter
+    def added(self, tags):
+        self._added = intern_tags(tags)
+
+    @property
+    def removed(self):
+        return self._removed
+
+    @removed.setter
+    def removed(self, tags):
+        self._removed = intern_tags(tags)
+
     def empty(self):
         """
         Return True if this patch does not contain any changes
         """
-        return not (self.added or self.removed)
+        return not (self._added or self._removed)
 
     def parse(self, text, blacklist_tags=[]):
+        added = []
+        removed = []
         for t in text.split(", "):
             tag = t[1:]
             if tag in blacklist_tags: continue
             if tag is None: continue
+            if isinstance(tag, str):
+                tag = intern(tag)
             if t[0] == '+':
-                self.added.add(tag)
+                added.append(tag)
             elif t[0] == '-':
-                self.removed.add(tag)
+                removed.append(tag)
+        if added:
+            self.added = self._added.union(added)
+        if removed:
+            self.removed = self._removed.union(removed)
 
     def apply(self, pkg, tagdb):
         """
@@ -41,9 +122,15 @@ class Patch(object):
             tagdb.rdb.setdefault(t, set()).add(pkg)
 
     def write(self, fd):
+        fd.write(self.text())
+
+    def text(self):
+        """
+        Return the patch as written to patch files
+        """
         bits = ['-' + t for t in sorted(self.removed)]
         bits += ['+' + t for t in sorted(self.added)]
-        fd.write(", ".join(bits))
+        return ", ".join(bits)
 
     def __str__(self):
         return ", ".join(itertools.chain(
@@ -54,10 +141,9 @@ class Patch(object):
         """
         Merge changes into this patch
         """
-        self.added |= added
-        self.removed -= added
-        self.removed |= removed
-        self.added -= removed
+        new_added = self._added | added
+        self.removed = (self._removed - added) | removed
+        self.added = new_added - removed
 
     def simplified(self, tags, tag_whitelist=None):
         """
@@ -87,10 +173,8 @@ class Patch(object):
         as if the given patch had been applied
         """
         res = Patch()
-        res.added = self.removed - patch.removed
-        res.added |= patch.added - self.added
-        res.removed = self.added - patch.added
-        res.removed |= patch.removed - self.removed
+        res.added = (self.removed - patch.removed) | (patch.added - self.added)
+        res.removed = (self.added - patch.added) | (patch.removed - self.removed)
         return res
 
 
@@ -114,26 +198,20 @@ class PatchSet(dict):
         return True
 
     def read(self, fname, blacklist_tags=[]):
-        with open(fname) as fd:
-            self.read_fd(fd, blacklist_tags=blacklist_tags)
+        """
+        Read a patch file, which can be compressed (see write_sorted)
+        """
+        with open(fname, "rb") as fd:
+            self.read_fd(iter_lines(fd), blacklist_tags=blacklist_tags)
 
     def read_fd(self, fd, blacklist_tags=[]):
-        for line in fd:
-            line = line.strip()
-            if not line: continue
-            try:
-                pkg, tags = line.split(": ", 1)
-            except ValueError:
-                # Gracefully ignore package names with empty patches
-                if re.match(r"^[^: ,]+:?$", line):
-                    continue
-                raise ValueError("Cannot parse line '%s'" % line)
-            if pkg in self:
-                self[pkg].parse(tags, blacklist_tags=blacklist_tags)
+        for pkg, patch in iter_patches(fd, blacklist_tags=blacklist_tags):
+            old = self.get(pkg, None)
+            if old is None:
+                self[pkg] = patch
             else:
-                patch = Patch(tags, blacklist_tags=blacklist_tags)
-                if not patch.empty():
-                    self[pkg] = patch
+                old.added = old.added | patch.added
+                old.removed = old.removed | patch.removed
 
     def write_fd(self, fd):
         for pkg, patch in self.iteritems():
@@ -146,6 +224,18 @@ class PatchSet(dict):
         with utils.atomic_writer(fname) as fd:
             self.write_fd(fd)
 
+    def write_sorted(self, fname, compress=None, block_size=64 * 1024):
+        """
+        Atomically write the patchset sorted by package name, optionally
+        compressed, with a PatchFileIndex in fname + ".idx".
+
+        compress can be None, "gzip", "bz2" or "xz" ("xz" needs the lzma
+        module). The file is written in independently compressed blocks of
+        about block_size uncompressed bytes, so that the index can point to
+        the block of each package.
+        """
+        write_patches(fname, sorted(self.iteritems()), compress, block_size)
+
     def apply_to(self, tagdb):
         """
         Apply patchset to a debtags.DB
@@ -173,6 +263,47 @@ class PatchSet(dict):
         for pkg, patch in patchset.iteritems():
             self.add(pkg, patch.added, patch.removed)
 
+    def merge_many(self, sources):
+        """
+        Merge many patchsets on top of this one, in a single pass.
+
+        The result is the same as calling add_patchset with each source in
+        order. Sources can be PatchSets, names of patch files sorted by
+        package (like those written by write_sorted), or sequences of
+        (pkg, Patch) sorted by package. Files are streamed, so only one
+        patch per source is in memory at any time.
+
+        Results are applied once all sources have been merged: if a source
+        turns out not to be sorted, ValueError is raised and this patchset
+        is left untouched.
+        """
+        merged = []
+        for pkg, group in itertools.groupby(iter_merged(sources), key=operator.itemgetter(0)):
+            patch = self.get(pkg, None)
+            if patch is None:
+                added = removed = None
+            else:
+                added, removed = patch.added, patch.removed
+            for name, p in group:
+                if added is None:
+                    added, removed = p.added, p.removed
+                else:
+                    # Same as Patch.add
+                    added, removed = (added | p.added) - p.removed, (removed - p.added) | p.removed
+            # Keep shared sets only, while waiting for the merge to finish
+            merged.append((pkg, intern_tags(added), intern_tags(removed)))
+
+        for pkg, added, removed in merged:
+            patch = self.get(pkg, None)
+            if patch is None:
+                if added or removed:
+                    self[pkg] = patch = Patch()
+                    patch.added = added
+                    patch.removed = removed
+            else:
+                patch.added = added
+                patch.removed = removed
+
     def simplified(self, tagdb, tag_whitelist=None):
         """
         Return a new patchset with only those changes that actually apply to
@@ -252,3 +383,399 @@ class PatchSet(dict):
 
     def __repr__(self):
         return "\n".join((k + ": " + str(v)) for k, v in self.iteritems())
+
+def iter_patches(fd, blacklist_tags=[]):
+    """
+    Generate (pkg, Patch) for each line of a patch file, in file order.
+
+    Lines with empty patches are skipped. If a package appears in more than
+    one line, it is generated once for each.
+    """
+    for line in fd:
+        line = line.strip()
+        if not line: continue
+        try:
+            pkg, tags = line.split(": ", 1)
+        except ValueError:
+            # Gracefully ignore package names with empty patches
+            if re.match(r"^[^: ,]+:?$", line):
+                continue
+            raise ValueError("Cannot parse line '%s'" % line)
+        patch = Patch(tags, blacklist_tags=blacklist_tags)
+        if not patch.empty():
+            yield pkg, patch
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        from backports import lzma
+    return lzma
+
+# Compression name -> (magic, function compressing a block, function
+# returning a decompressor object)
+COMPRESSORS = {
+    "gzip": ("\x1f\x8b",
+             lambda data: _gzip_compress(data),
+             lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    "bz2": ("BZh",
+            lambda data: bz2.compress(data),
+            lambda: bz2.BZ2Decompressor()),
+    "xz": ("\xfd7zXZ\x00",
+           lambda data: _lzma().compress(data),
+           lambda: _lzma().LZMADecompressor()),
+}
+
+def _gzip_compress(data):
+    comp = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return comp.compress(data) + comp.flush()
+
+def detect_compression(head):
+    """
+    Return the name of the compression of a file starting with head, or
+    None if it is not compressed
+    """
+    for name, (magic, compress, decompressor) in COMPRESSORS.iteritems():
+        if head.startswith(magic):
+            return name
+    return None
+
+def iter_decompressed(bufs, compress):
+    """
+    Decompress a sequence of buffers with the data of one or more
+    concatenated compressed streams
+    """
+    factory = COMPRESSORS[compress][2]
+    dec = factory()
+    for buf in bufs:
+        while buf:
+            try:
+                data = dec.decompress(buf)
+            except EOFError:
+                # The previous stream ended exactly at the end of a buffer
+                dec = factory()
+                continue
+            if data:
+                yield data
+            buf = dec.unused_data
+            if buf:
+                dec = factory()
+
+def iter_lines(fd, bufsize=1024 * 1024):
+    """
+    Generate the lines of a patch file, decompressing it if needed
+    """
+    head = fd.read(8)
+    chunks = itertools.chain((head,), utils.read_chunks(fd, bufsize))
+    compress = detect_compression(head)
+    if compress is not None:
+        chunks = iter_decompressed(chunks, compress)
+    return utils.split_lines(chunks)
+
+# Read size for each of the files of a merge_many, which can have many of
+# them open at the same time
+MERGE_BUFSIZE = 64 * 1024
+
+def _iter_sorted_source(source, num):
+    """
+    Generate (pkg, num, Patch) for a merge_many source, checking that it is
+    sorted
+    """
+    if isinstance(source, dict):
+        for pkg in sorted(source):
+            yield pkg, num, source[pkg]
+        return
+
+    if isinstance(source, basestring):
+        fd = open(source, "rb")
+        items = iter_patches(iter_lines(fd, bufsize=MERGE_BUFSIZE))
+    else:
+        fd = None
+        items = source
+    try:
+        last = None
+        for pkg, group in itertools.groupby(items, key=operator.itemgetter(0)):
+            if last is not None and pkg < last:
+                raise ValueError("source %d of the merge is not sorted: %s after %s" % (num, pkg, last))
+            last = pkg
+            patch = next(group)[1]
+            for name, p in group:
+                # Repeated lines are merged like PatchSet.read_fd does
+                merged = Patch()
+                merged.added = patch.added | p.added
+                merged.removed = patch.removed | p.removed
+                patch = merged
+            yield pkg, num, patch
+    finally:
+        if fd is not None:
+            fd.close()
+
+def iter_merged(sources):
+    """
+    Generate (pkg, Patch) for all the patches of the given sources (see
+    PatchSet.merge_many), sorted by package and then by source, with a heap
+    based k-way merge
+    """
+    streams = [_iter_sorted_source(s, num) for num, s in enumerate(sources)]
+    for pkg, num, patch in heapq.merge(*streams):
+        yield pkg, patch
+
+INDEX_VERSION = 1
+
+def write_patches(fname, items, compress=None, block_size=64 * 1024):
+    """
+    Atomically write a sequence of (pkg, Patch) sorted by package name, with
+    their PatchFileIndex (see PatchSet.write_sorted)
+    """
+    if compress is not None:
+        compress_block = COMPRESSORS[compress][1]
+    names = []
+    offsets = array.array("L")
+    pos = 0
+    with utils.atomic_writer(fname) as fd:
+        block = []
+        size = 0
+        last = None
+        for pkg, patch in itertools.chain(items, ((None, None),)):
+            if pkg is not None:
+                if last is not None and pkg <= last:
+                    raise ValueError("patches are not sorted: %s after %s" % (pkg, last))
+                last = pkg
+                line = "%s: %s\n" % (pkg, patch.text())
+            if block and (pkg is None or size + len(line) > block_size):
+                data = "".join(block)
+                if compress is not None:
+                    data = compress_block(data)
+                fd.write(data)
+                offsets.append(pos)
+                pos += len(data)
+                block = []
+                size = 0
+            if pkg is None: break
+            if not block:
+                names.append(pkg)
+            block.append(line)
+            size += len(line)
+        offsets.append(pos)
+
+        with utils.atomic_writer(fname + ".idx") as idx:
+            idx.write(marshal.dumps(dict(
+                version=INDEX_VERSION,
+                compress=compress,
+                names=names,
+                offsets=offsets.tostring(),
+            ), 2))
+
+class PatchFileIndex(object):
+    """
+    Look up single packages in a patch file written by write_sorted,
+    reading and decompressing only the block that contains them
+    """
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname + ".idx", "rb") as fd:
+            data = marshal.load(fd)
+        if data.get("version") != INDEX_VERSION:
+            raise ValueError("%s.idx has an unsupported version" % fname)
+        self.compress = data["compress"]
+        self.names = data["names"]
+        self.offsets = array.array("L", data["offsets"])
+        if os.path.getsize(fname) != self.offsets[-1]:
+            raise ValueError("%s.idx does not match %s" % (fname, fname))
+
+    def __len__(self):
+        return len(self.names)
+
+    def get(self, pkg, default=None, blacklist_tags=[]):
+        """
+        Return the Patch for pkg, or default if it is not in the file
+        """
+        pos = bisect.bisect_right(self.names, pkg) - 1
+        if pos < 0:
+            return default
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        with open(self.fname, "rb") as fd:
+            fd.seek(start)
+            data = fd.read(end - start)
+        if self.compress is not None:
+            data = COMPRESSORS[self.compress][2]().decompress(data)
+        prefix = pkg + ": "
+        for line in data.split("\n"):
+            if line.startswith(prefix):
+                for name, patch in iter_patches((line,), blacklist_tags=blacklist_tags):
+                    return patch
+        return default
+
+DiffStats = collections.namedtuple("DiffStats", (
+    "packages_added", "packages_removed", "packages_changed", "packages_unchanged",
+    "tags_added", "tags_removed"))
+
+def diff_dbs(old, new):
+    """
+    Compare two tag databases, returning a PatchSet that turns old into new
+    when applied with apply_to, and DiffStats with counts of what changed.
+
+    Packages only in old get a patch removing all their tags, since a patch
+    cannot remove a package. Packages with no tags only in one of the
+    databases need no patch, and are counted as unchanged if in old and not
+    counted if in new, so that added, removed and changed packages are
+    those with a patch.
+    """
+    res = PatchSet()
+    added = removed = changed = unchanged = tags_added = tags_removed = 0
+
+    key = operator.itemgetter(0)
+    old_items = iter(sorted(old.iter_packages_tags(), key=key))
+    new_items = iter(sorted(new.iter_packages_tags(), key=key))
+    old_pkg, old_tags = next(old_items, (None, None))
+    new_pkg, new_tags = next(new_items, (None, None))
+    while old_pkg is not None or new_pkg is not None:
+        if new_pkg is None or (old_pkg is not None and old_pkg < new_pkg):
+            # Only in old
+            if old_tags:
+                res[old_pkg] = patch = Patch()
+                patch.removed = set(old_tags)
+                tags_removed += len(old_tags)
+                removed += 1
+            else:
+                unchanged += 1
+            old_pkg, old_tags = next(old_items, (None, None))
+        elif old_pkg is None or new_pkg < old_pkg:
+            # Only in new
+            if new_tags:
+                res[new_pkg] = patch = Patch()
+                patch.added = set(new_tags)
+                tags_added += len(new_tags)
+                added += 1
+            new_pkg, new_tags = next(new_items, (None, None))
+        else:
+            # Views like PatchedDB share unchanged tag sets: check identity
+            # before comparing contents
+            if old_tags is new_tags or old_tags == new_tags:
+                unchanged += 1
+            else:
+                res[new_pkg] = patch = Patch()
+                patch.added = new_tags - old_tags
+                patch.removed = old_tags - new_tags
+                tags_added += len(patch.added)
+                tags_removed += len(patch.removed)
+                changed += 1
+            old_pkg, old_tags = next(old_items, (None, None))
+            new_pkg, new_tags = next(new_items, (None, None))
+
+    return res, DiffStats(added, removed, changed, unchanged, tags_added, tags_removed)
+
+class PatchedDB(object):
+    """
+    Read-only view of a tag database with patchsets applied on top.
+
+    The base database, which can be a debtags.DB or anything with the same
+    read API, is shared and never modified: only the tag sets of packages
+    touched by the patchsets are computed and stored. The result is the
+    same as a copy of the base after calling apply_to with each patchset in
+    order. The base should not change while the view is in use.
+    """
+    def __init__(self, base, *patchsets):
+        self.base = base
+        self.patchsets = []
+        # pkg -> patched tag set, for packages touched by the patchsets
+        self.touched = dict()
+        # tag -> (packages that gained it, packages that lost it), computed
+        # on first use
+        self._tag_delta = None
+        for ps in patchsets:
+            self.add_patchset(ps)
+
+    def add_patchset(self, patchset):
+        """
+        Apply a patchset on top of those already in the view
+        """
+        self.patchsets.append(patchset)
+        base = self.base
+        for pkg, patch in patchset.iteritems():
+            tags = self.touched.get(pkg, None)
+            if tags is None:
+                tags = self.touched[pkg] = set(base.tags_of_package(pkg))
+            tags -= patch.removed
+            tags |= patch.added
+        self._tag_delta = None
+
+    @property
+    def tag_delta(self):
+        if self._tag_delta is None:
+            delta = dict()
+            base = self.base
+            for pkg, tags in self.touched.iteritems():
+                old = base.tags_of_package(pkg)
+                for t in tags - old:
+                    delta.setdefault(t, (set(), set()))[0].add(pkg)
+                for t in old - tags:
+                    delta.setdefault(t, (set(), set()))[1].add(pkg)
+            self._tag_delta = delta
+        return self._tag_delta
+
+    def has_package(self, pkg):
+        return pkg in self.touched or self.base.has_package(pkg)
+
+    def has_tag(self, tag):
+        return self.card(tag) > 0
+
+    def tags_of_package(self, pkg):
+        tags = self.touched.get(pkg, None)
+        if tags is not None:
+            return tags
+        return self.base.tags_of_package(pkg)
+
+    def packages_of_tag(self, tag):
+        pkgs = self.base.packages_of_tag(tag)
+        delta = self.tag_delta.get(tag, None)
+        if delta is None:
+            return pkgs
+        added, removed = delta
+        return (pkgs - removed) | added
+
+    def card(self, tag):
+        delta = self.tag_delta.get(tag, None)
+        if delta is None:
+            return self.base.card(tag)
+        return len(self.packages_of_tag(tag))
+
+    def iter_packages(self):
+        for pkg in self.base.iter_packages():
+            yield pkg
+        for pkg in self.touched:
+            if not self.base.has_package(pkg):
+                yield pkg
+
+    def iter_tags(self):
+        for tag, pkgs in self.iter_tags_packages():
+            yield tag
+
+    def iter_packages_tags(self):
+        touched = self.touched
+        for pkg, tags in self.base.iter_packages_tags():
+            yield pkg, touched.get(pkg, tags)
+        for pkg, tags in touched.iteritems():
+            if not self.base.has_package(pkg):
+                yield pkg, tags
+
+    def iter_tags_packages(self):
+        delta = self.tag_delta
+        for tag, pkgs in self.base.iter_tags_packages():
+            if tag in delta:
+                pkgs = self.packages_of_tag(tag)
+            if pkgs:
+                yield tag, pkgs
+        for tag in delta:
+            if not self.base.has_tag(tag):
+                yield tag, self.packages_of_tag(tag)
+
+    def package_count(self):
+        count = self.base.package_count()
+        for pkg in self.touched:
+            if not self.base.has_package(pkg):
+                count += 1
+        return count
+
+    def tag_count(self):
+        return sum(1 for t in self.iter_tags())
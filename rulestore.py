@@ -0,0 +1,175 @@
+import os.path
+import mmap
+import struct
+import json
+import logging
+import utils
+from apriori import Apriori, AprioriResult
+
+log = logging.getLogger(__name__)
+
+class RuleStore(object):
+    """
+    Memory mapped, read-only store of AprioriResult rules.
+
+    The file contains a header with the fingerprint of the tag database the
+    rules were mined from and the mining parameters, a table of interned tag
+    names, fixed size rule records, and the antecedent tag IDs of the rules.
+    Rules are decoded only when accessed.
+    """
+    MAGIC = "DTRULES\0"
+    VERSION = 1
+    # magic, version, metadata length, number of tags, number of rules
+    HEADER = struct.Struct("<8sIIII")
+    # target tag ID, antecedent start, antecedent length, support, confidence
+    RULE = struct.Struct("<IIIdd")
+    ID = struct.Struct("<I")
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, "rb") as fd:
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self.map) < self.HEADER.size:
+            raise ValueError("%s is not a rule store" % fname)
+        magic, version, meta_len, self.tag_count, self.rule_count = self.HEADER.unpack_from(self.map, 0)
+        if magic != self.MAGIC:
+            raise ValueError("%s is not a rule store" % fname)
+        if version != self.VERSION:
+            raise ValueError("%s has unsupported rule store version %d" % (fname, version))
+
+        pos = self.HEADER.size
+        meta = json.loads(self.map[pos:pos + meta_len])
+        self.fingerprint = meta["fingerprint"]
+        self.params = meta["params"]
+        pos += meta_len
+
+        self.tag_offsets = pos
+        pos += (self.tag_count + 1) * self.ID.size
+        self.tag_data = pos
+        pos += self._tag_offset(self.tag_count)
+        self.rule_data = pos
+        self.src_data = pos + self.rule_count * self.RULE.size
+
+        self._tags = [None] * self.tag_count
+        self._srcs = dict()
+
+    def close(self):
+        """
+        Unmap the store file. Rules cannot be accessed afterwards.
+        """
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _tag_offset(self, tid):
+        return self.ID.unpack_from(self.map, self.tag_offsets + tid * self.ID.size)[0]
+
+    def tag(self, tid):
+        """
+        Return the name of the tag with the given ID
+        """
+        res = self._tags[tid]
+        if res is None:
+            start = self.tag_data + self._tag_offset(tid)
+            end = self.tag_data + self._tag_offset(tid + 1)
+            res = self._tags[tid] = self.map[start:end]
+        return res
+
+    def _src(self, start, length):
+        res = self._srcs.get(start, None)
+        if res is None:
+            pos = self.src_data + start * self.ID.size
+            ids = struct.unpack_from("<%dI" % length, self.map, pos)
+            res = self._srcs[start] = frozenset(self.tag(x) for x in ids)
+        return res
+
+    def __len__(self):
+        return self.rule_count
+
+    def __getitem__(self, idx):
+        if idx < 0: idx += self.rule_count
+        if idx < 0 or idx >= self.rule_count:
+            raise IndexError("rule index out of range")
+        tgt, start, length, sus, conf = self.RULE.unpack_from(self.map, self.rule_data + idx * self.RULE.size)
+        return AprioriResult(self._src(start, length), self.tag(tgt), sus, conf)
+
+    def __iter__(self):
+        for idx in xrange(self.rule_count):
+            yield self[idx]
+
+    def matches(self, fingerprint, params):
+        """
+        Check if the store was built from the given database fingerprint and
+        mining parameters
+        """
+        return self.fingerprint == fingerprint and self.params == params
+
+    @classmethod
+    def write(cls, fname, rules, fingerprint, params):
+        """
+        Atomically write a rule store with the given rules
+        """
+        tag_ids = dict()
+        tags = []
+        def intern(tag):
+            tid = tag_ids.get(tag, None)
+            if tid is None:
+                tid = tag_ids[tag] = len(tags)
+                tags.append(tag)
+            return tid
+
+        # Identical antecedents are stored only once
+        src_starts = dict()
+        src_ids = []
+        records = []
+        for r in rules:
+            src = tuple(sorted(intern(t) for t in r.src))
+            start = src_starts.get(src, None)
+            if start is None:
+                start = src_starts[src] = len(src_ids)
+                src_ids.extend(src)
+            records.append(cls.RULE.pack(intern(r.tgt), start, len(src), r.sus, r.conf))
+
+        meta = json.dumps(dict(fingerprint=fingerprint, params=params), sort_keys=True)
+        offsets = [0]
+        for t in tags:
+            offsets.append(offsets[-1] + len(t))
+
+        with utils.atomic_writer(fname) as fd:
+            fd.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(meta), len(tags), len(records)))
+            fd.write(meta)
+            fd.write(struct.pack("<%dI" % len(offsets), *offsets))
+            fd.write("".join(tags))
+            fd.write("".join(records))
+            fd.write(struct.pack("<%dI" % len(src_ids), *src_ids))
+
+def build(fname, tags_fname, apriori=None):
+    """
+    Return the RuleStore at fname, mining the debtags database in tags_fname
+    to (re)build it if it does not exist or if it was built from a different
+    database or with different parameters
+    """
+    if apriori is None:
+        apriori = Apriori(quiet=True)
+    fingerprint = utils.file_fingerprint(tags_fname)
+    params = apriori.parameters()
+
+    if os.path.exists(fname):
+        try:
+            store = RuleStore(fname)
+        except ValueError as e:
+            log.warning("Rebuilding %s: %s", fname, e)
+        else:
+            if store.matches(fingerprint, params):
+                return store
+            store.close()
+            log.info("Rebuilding %s: database or parameters changed", fname)
+
+    db = Apriori.read_debtags_db(tags_fname)
+    RuleStore.write(fname, apriori.run_apriori(db), fingerprint, params)
+    return RuleStore(fname)
@@ -0,0 +1,150 @@
+import array
+import threading
+import bitsetdb
+
+class TagInterner(object):
+    """
+    Map tags and facets to dense integer IDs.
+
+    IDs are allocated on demand and never change, so they can be shared by
+    all the code running in a process: use the module level interner
+    instead of creating new instances.
+    """
+    def __init__(self):
+        self.tags = []
+        self.tag_ids_by_name = dict()
+        self.facets = []
+        self.facet_ids_by_name = dict()
+        # Tag ID -> facet ID
+        self.tag_facet = array.array("I")
+        # Facet ID -> bitmask of the IDs of its tags
+        self.facet_masks = []
+        self.lock = threading.Lock()
+
+    def seed(self, vocabulary):
+        """
+        Allocate IDs for all the facets and tags of a Vocabulary data
+        source, in sorted order
+        """
+        for name in sorted(vocabulary.facets):
+            self.facet_id(name)
+        for name in sorted(vocabulary.tags):
+            self.tag_id(name)
+
+    def facet_id(self, facet):
+        """
+        Return the ID of a facet, allocating it if needed
+        """
+        res = self.facet_ids_by_name.get(facet, None)
+        if res is not None:
+            return res
+        with self.lock:
+            res = self.facet_ids_by_name.get(facet, None)
+            if res is None:
+                res = len(self.facets)
+                self.facets.append(facet)
+                self.facet_masks.append(0)
+                self.facet_ids_by_name[facet] = res
+        return res
+
+    def tag_id(self, tag):
+        """
+        Return the ID of a tag, allocating it if needed
+        """
+        res = self.tag_ids_by_name.get(tag, None)
+        if res is not None:
+            return res
+        fid = self.facet_id(tag.split("::")[0])
+        with self.lock:
+            res = self.tag_ids_by_name.get(tag, None)
+            if res is None:
+                res = len(self.tags)
+                self.tags.append(tag)
+                self.tag_facet.append(fid)
+                self.facet_masks[fid] |= 1 << res
+                self.tag_ids_by_name[tag] = res
+        return res
+
+    def tag(self, tid):
+        """
+        Return the name of a tag ID
+        """
+        return self.tags[tid]
+
+    def facet(self, fid):
+        """
+        Return the name of a facet ID
+        """
+        return self.facets[fid]
+
+    def facet_of(self, tid):
+        """
+        Return the facet ID of a tag ID
+        """
+        return self.tag_facet[tid]
+
+    def tag_ids(self, tags):
+        """
+        Convert a sequence of tags into a frozenset of tag IDs
+        """
+        return frozenset(self.tag_id(t) for t in tags)
+
+    def tag_names(self, ids):
+        """
+        Convert a sequence of tag IDs into a frozenset of tags
+        """
+        return frozenset(self.tags[i] for i in ids)
+
+    def facet_ids(self, ids):
+        """
+        Convert a sequence of tag IDs into the frozenset of their facet IDs
+        """
+        return frozenset(self.tag_facet[i] for i in ids)
+
+    def mask(self, tags):
+        """
+        Convert a sequence of tags into a bitmask of tag IDs
+        """
+        res = 0
+        for t in tags:
+            res |= 1 << self.tag_id(t)
+        return res
+
+    def mask_of_ids(self, ids):
+        """
+        Convert a sequence of tag IDs into a bitmask
+        """
+        res = 0
+        for i in ids:
+            res |= 1 << i
+        return res
+
+    def ids_of_mask(self, mask):
+        """
+        Return the list of tag IDs set in a bitmask
+        """
+        return list(bitsetdb.ids_of_bits(mask))
+
+    def tag_names_of_mask(self, mask):
+        """
+        Convert a bitmask of tag IDs into a frozenset of tags
+        """
+        return self.tag_names(self.ids_of_mask(mask))
+
+    def facet_mask(self, facet):
+        """
+        Return the bitmask of the IDs of all the tags of a facet
+        """
+        fid = self.facet_ids_by_name.get(facet, None)
+        if fid is None:
+            return 0
+        return self.facet_masks[fid]
+
+    def has_facet(self, mask, facet):
+        """
+        Check if a bitmask of tag IDs has any tag of the given facet
+        """
+        return bool(mask & self.facet_mask(facet))
+
+# Interner shared by the whole process
+interner = TagInterner()
@@ -0,0 +1,206 @@
+import os.path
+import marshal
+import array
+import logging
+import gc
+import hashlib
+from debian import debtags
+import utils
+import bitsetdb
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+def read_snapshot_data(fname, source, filter_key):
+    """
+    Load the data of the snapshot fname built from the tag file source, or
+    return None if the snapshot is missing or out of date
+    """
+    try:
+        with open(fname, "rb") as fd:
+            data = marshal.load(fd)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != VERSION:
+        return None
+    if data["filter"] != filter_key:
+        return None
+
+    if utils.unchanged_file_key(source, data["size"], data["mtime"], data["hash"]) is None:
+        return None
+    return data
+
+def read_snapshot(fname, source, filter_key):
+    """
+    Load a debtags.DB from the snapshot fname built from the tag file
+    source, or return None if the snapshot is missing or out of date
+    """
+    data = read_snapshot_data(fname, source, filter_key)
+    if data is None:
+        return None
+
+    tags, pkgs = data["tags"], data["pkgs"]
+    db = debtags.DB()
+    # Building many sets at once would trigger the cyclic garbage collector
+    # over and over, for no benefit
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        db.db = dict(decode(pkgs, tags, data["ids"], data["offsets"]))
+        db.rdb = dict(decode(tags, pkgs, data["rids"], data["roffsets"]))
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return db
+
+def read_snapshot_arrays(fname, source, filter_key):
+    """
+    Load the (pkgs, tags, ids, offsets) arrays (see encode) from the
+    snapshot fname built from the tag file source, or return None if the
+    snapshot is missing or out of date
+    """
+    data = read_snapshot_data(fname, source, filter_key)
+    if data is None:
+        return None
+    return data["pkgs"], data["tags"], array.array("I", data["ids"]), array.array("I", data["offsets"])
+
+def decode(keys, values, ids, offsets):
+    """
+    Generate (key, set of values) pairs from the serialized arrays of value
+    IDs and of the offsets where the IDs of each key end
+    """
+    ids = array.array("I", ids)
+    offsets = array.array("I", offsets)
+    get = values.__getitem__
+    start = 0
+    for key, end in zip(keys, offsets):
+        yield key, set(map(get, ids[start:end]))
+        start = end
+
+def encode(db):
+    """
+    Encode a tag database as (pkgs, tags, ids, offsets), where pkgs and
+    tags are lists of names, ids is an array with the indices in tags of
+    the tags of each package, and offsets is an array with the position in
+    ids where the tags of each package end
+    """
+    pkgs = []
+    tags = []
+    tag_ids = dict()
+    ids = array.array("I")
+    offsets = array.array("I")
+    for pkg, pkgtags in db.iter_packages_tags():
+        for t in pkgtags:
+            tid = tag_ids.get(t, None)
+            if tid is None:
+                tid = tag_ids[t] = len(tags)
+                tags.append(t)
+            ids.append(tid)
+        pkgs.append(pkg)
+        offsets.append(len(ids))
+    return pkgs, tags, ids, offsets
+
+def write_snapshot(fname, source, filter_key, db):
+    """
+    Write a snapshot of db, read from the tag file source
+    """
+    # Package -> tag IDs
+    pkgs, tags, ids, offsets = encode(db)
+
+    # Tag -> package IDs, in the same order as tags
+    by_tag = [[] for t in tags]
+    start = 0
+    for pid, end in enumerate(offsets):
+        for tid in ids[start:end]:
+            by_tag[tid].append(pid)
+        start = end
+    rids = array.array("I")
+    roffsets = array.array("I")
+    for pids in by_tag:
+        rids.extend(pids)
+        roffsets.append(len(rids))
+
+    size, mtime = utils.file_key(source)
+    data = dict(
+        version=VERSION,
+        size=size,
+        mtime=mtime,
+        hash=utils.file_fingerprint(source),
+        filter=filter_key,
+        tags=tags,
+        pkgs=pkgs,
+        ids=ids.tostring(),
+        offsets=offsets.tostring(),
+        rids=rids.tostring(),
+        roffsets=roffsets.tostring(),
+    )
+    with utils.atomic_writer(fname, sync=False) as fd:
+        fd.write(marshal.dumps(data, 2))
+
+def snapshot_name(fname, filter_key="", snapshot_dir=None):
+    """
+    Return the name of the snapshot of the tag file fname read with the
+    filter identified by filter_key, in snapshot_dir or, by default, next
+    to fname.
+
+    Each filter gets its own snapshot, so that readers with different
+    filters do not replace each other's.
+    """
+    if snapshot_dir is None:
+        snapshot_dir = os.path.dirname(fname)
+    digest = hashlib.sha1(filter_key).hexdigest()[:12]
+    return os.path.join(snapshot_dir, "%s.%s.snapshot" % (os.path.basename(fname), digest))
+
+def parse_tags(fname, tag_filter, filter_key, snapshot_fname):
+    """
+    Parse a tag file into a debtags.DB, writing its snapshot to
+    snapshot_fname
+    """
+    db = debtags.DB()
+    with open(fname, "r") as fd:
+        db.read(fd, tag_filter)
+
+    try:
+        write_snapshot(snapshot_fname, fname, filter_key, db)
+    except (IOError, OSError) as e:
+        log.warning("Cannot write snapshot %s: %s", snapshot_fname, e)
+    return db
+
+def read_tags(fname, tag_filter=None, filter_key="", snapshot_fname=None, snapshot_dir=None, bitset=False):
+    """
+    Read a debtags database, using a binary snapshot of it if one is
+    available and up to date, or building the snapshot if not.
+
+    tag_filter is used as in debtags.DB.read, and filter_key is a string
+    identifying it, so that snapshots built with a different filter are not
+    used. The snapshot is stored in snapshot_fname, by default the one
+    given by snapshot_name; if it cannot be written, the database is
+    returned anyway.
+
+    If bitset is True, a bitsetdb.BitsetDB is returned instead of a
+    debtags.DB.
+    """
+    if bitset:
+        return bitsetdb.BitsetDB.from_arrays(*read_tag_arrays(
+            fname, tag_filter, filter_key, snapshot_fname, snapshot_dir))
+
+    if snapshot_fname is None:
+        snapshot_fname = snapshot_name(fname, filter_key, snapshot_dir)
+    db = read_snapshot(snapshot_fname, fname, filter_key)
+    if db is None:
+        db = parse_tags(fname, tag_filter, filter_key, snapshot_fname)
+    return db
+
+def read_tag_arrays(fname, tag_filter=None, filter_key="", snapshot_fname=None, snapshot_dir=None):
+    """
+    Like read_tags, but return the database encoded as (pkgs, tags, ids,
+    offsets) arrays (see encode), which only contain tag names and can be
+    turned into a bitsetdb.BitsetDB with BitsetDB.from_arrays
+    """
+    if snapshot_fname is None:
+        snapshot_fname = snapshot_name(fname, filter_key, snapshot_dir)
+    res = read_snapshot_arrays(snapshot_fname, fname, filter_key)
+    if res is None:
+        res = encode(parse_tags(fname, tag_filter, filter_key, snapshot_fname))
+    return res
@@ -1,6 +1,21 @@
 import unittest
+import os
+import random
+import tempfile
+import shutil
+import pickle
+from StringIO import StringIO
 from debian import debtags
 from debdata import patches
+from debdata import apriori
+from debdata import rulestore
+from debdata import tagsnapshot
+from debdata import datasources
+from debdata import depgraph
+from debdata import autotag
+from debdata import tagids
+from debdata import bitsetdb
+from debdata import utils
 
 class TestPatches(unittest.TestCase):
     def test_simplify(self):
@@ -13,3 +28,1037 @@ class TestPatches(unittest.TestCase):
         ps1 = ps.simplified(db)
 
         self.assertEquals(ps1, dict())
+
+    def test_patch(self):
+        p = patches.Patch("+role::program, -special::not-yet-tagged, +use::viewing")
+        self.assertEquals(p.added, frozenset(("role::program", "use::viewing")))
+        self.assertEquals(p.removed, frozenset(("special::not-yet-tagged",)))
+        self.assertEquals(p.text(), "-special::not-yet-tagged, +role::program, +use::viewing")
+        self.assertEquals(str(p), "+role::program, +use::viewing, -special::not-yet-tagged")
+        self.assertFalse(p.empty())
+        self.assertTrue(patches.Patch().empty())
+        self.assertRaises(AttributeError, setattr, p, "other", 1)
+
+        # Equal tag sets are shared
+        q = patches.Patch("+use::viewing, +role::program")
+        self.assertIs(q.added, p.added)
+        self.assertIs(patches.Patch().removed, q.removed)
+
+        q.add(added=frozenset(("special::not-yet-tagged",)), removed=frozenset(("use::viewing",)))
+        self.assertEquals(q.added, frozenset(("role::program", "special::not-yet-tagged")))
+        self.assertEquals(q.removed, frozenset(("use::viewing",)))
+        # p is unchanged
+        self.assertEquals(p.added, frozenset(("role::program", "use::viewing")))
+
+        tags = set(("role::program", "special::not-yet-tagged"))
+        self.assertEquals(str(p.simplified(tags)), "+use::viewing, -special::not-yet-tagged")
+        self.assertIsNone(patches.Patch("+role::program").simplified(tags))
+        diff = p.diff(q)
+        self.assertEquals(str(diff), "+special::not-yet-tagged, -use::viewing")
+
+        for protocol in 0, 1, 2:
+            ps = patches.PatchSet()
+            ps["pkg"] = p
+            res = pickle.loads(pickle.dumps(ps, protocol))
+            self.assertEquals(res.sorted_for_presentation, ps.sorted_for_presentation)
+            # Unpickled sets are shared again
+            self.assertIs(res["pkg"].added, p.added)
+
+    def test_tagsets_released(self):
+        import gc
+        gc.collect()
+        patches.prune_tagsets()
+        before = len(patches._tagsets)
+        for i in range(100):
+            ps = patches.PatchSet()
+            ps.add("pkg", set(("oneoff::tag%d" % i, "role::program")))
+        del ps
+        gc.collect()
+        patches.prune_tagsets()
+        self.assertEquals(len(patches._tagsets), before)
+        # Sets still in use are kept
+        p = patches.Patch("+oneoff::kept, +role::program")
+        patches.prune_tagsets()
+        self.assertIs(patches.Patch("+role::program, +oneoff::kept").added, p.added)
+
+        # The table is pruned as it grows
+        for i in range(5000):
+            patches.Patch("+oneoff::tag%d" % i)
+        self.assertTrue(len(patches._tagsets) < 2048)
+
+    def test_patched_db(self):
+        db = make_synthetic_db(seed=8)
+        rnd = random.Random(8)
+        tags = sorted(db.iter_tags()) + ["new::tag"]
+        pkgs = sorted(db.iter_packages()) + ["newpkg"]
+        patchsets = []
+        for i in range(3):
+            ps = patches.PatchSet()
+            for pkg in rnd.sample(pkgs, 40):
+                ps.add(pkg, set(rnd.sample(tags, 2)), set(rnd.sample(tags, 2)))
+            patchsets.append(ps)
+
+        base = dict((pkg, set(ts)) for pkg, ts in db.iter_packages_tags())
+        view = patches.PatchedDB(db, *patchsets)
+
+        expected = debtags.DB()
+        expected.read("%s: %s\n" % (pkg, ", ".join(sorted(ts))) for pkg, ts in db.iter_packages_tags())
+        for ps in patchsets:
+            ps.apply_to(expected)
+        rdb = dict((t, ps) for t, ps in expected.rdb.iteritems() if ps)
+
+        self.assertEquals(dict(view.iter_packages_tags()), expected.db)
+        self.assertEquals(dict(view.iter_tags_packages()), rdb)
+        self.assertEquals(sorted(view.iter_packages()), sorted(expected.db))
+        self.assertEquals(sorted(view.iter_tags()), sorted(rdb))
+        self.assertEquals(view.package_count(), len(expected.db))
+        self.assertEquals(view.tag_count(), len(rdb))
+        for tag in tags:
+            self.assertEquals(view.packages_of_tag(tag), rdb.get(tag, set()))
+            self.assertEquals(view.card(tag), len(rdb.get(tag, ())))
+            self.assertEquals(view.has_tag(tag), tag in rdb)
+        for pkg in pkgs:
+            self.assertEquals(view.tags_of_package(pkg), expected.tags_of_package(pkg))
+            self.assertEquals(view.has_package(pkg), pkg in expected.db)
+
+        # The base database is untouched
+        self.assertEquals(dict(db.iter_packages_tags()), base)
+
+    def test_diff_dbs(self):
+        old = make_synthetic_db(seed=9)
+        new = make_synthetic_db(seed=10)
+        ps, stats = patches.diff_dbs(old, new)
+        self.assertEquals(stats.packages_changed + stats.packages_added + stats.packages_removed, len(ps))
+        self.assertEquals(stats.packages_changed + stats.packages_unchanged + stats.packages_removed,
+                          old.package_count())
+
+        old.read("%s: %s\n" % (pkg, ", ".join(sorted(ts))) for pkg, ts in old.iter_packages_tags())
+        ps.apply_to(old)
+        # Packages only in old are left with no tags
+        self.assertEquals(dict((p, ts) for p, ts in old.iter_packages_tags() if ts), new.db)
+
+        self.assertEquals(patches.diff_dbs(new, new)[0], dict())
+
+        # Packages with no tags need no patch, and are not counted as added
+        # or removed
+        new.insert("notags-new", set())
+        old.insert("notags-old", set())
+        ps, stats = patches.diff_dbs(old, new)
+        self.assertEquals(len(ps), 0)
+        self.assertEquals(stats.packages_added + stats.packages_removed + stats.packages_changed, 0)
+        self.assertEquals(stats.packages_unchanged, old.package_count())
+
+        # Diffing a patched view against its base gives the patchset back
+        base = make_synthetic_db(seed=9)
+        view = patches.PatchedDB(base, ps)
+        back, stats = patches.diff_dbs(base, view)
+        self.assertEquals(back.sorted_for_presentation, ps.sorted_for_presentation)
+
+    def test_iter_patches(self):
+        text = "a: +role::program, -special::not-yet-tagged\nb:\nc: -x::y\na: +use::viewing\n"
+        res = [(pkg, str(p)) for pkg, p in patches.iter_patches(StringIO(text))]
+        self.assertEquals(res, [("a", "+role::program, -special::not-yet-tagged"),
+                                ("c", "-x::y"), ("a", "+use::viewing")])
+        ps = patches.PatchSet(fd=StringIO(text))
+        self.assertEquals(ps.sorted_for_presentation, [
+            ("a", ["role::program", "use::viewing"], ["special::not-yet-tagged"]),
+            ("c", [], ["x::y"])])
+        self.assertRaises(ValueError, list, patches.iter_patches(StringIO("a b c\n")))
+
+    def test_write_sorted(self):
+        rnd = random.Random(11)
+        tags = ["facet%d::tag%d" % (i % 5, i) for i in range(30)]
+        ps = patches.PatchSet()
+        for i in range(2000):
+            ps.add("pkg%d" % i, set(rnd.sample(tags, 3)), set(rnd.sample(tags, 1)))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "patch")
+            for compress in None, "gzip", "bz2":
+                ps.write_sorted(fname, compress=compress, block_size=4096)
+                with open(fname, "rb") as fd:
+                    self.assertEquals(patches.detect_compression(fd.read(8)), compress)
+                    fd.seek(0)
+                    pkgs = [pkg for pkg, p in patches.iter_patches(patches.iter_lines(fd, bufsize=1000))]
+                self.assertEquals(pkgs, sorted(ps.keys()))
+                self.assertEquals(patches.PatchSet(fname).sorted_for_presentation, ps.sorted_for_presentation)
+
+                index = patches.PatchFileIndex(fname)
+                self.assertTrue(len(index) > 1)
+                for pkg in "pkg0", "pkg999", "pkg1999", "pkg42":
+                    self.assertEquals(str(index.get(pkg)), str(ps[pkg]))
+                self.assertIsNone(index.get("missing"))
+                self.assertIsNone(index.get("aaa"))
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_merge_many(self):
+        rnd = random.Random(12)
+        tags = ["facet%d::tag%d" % (i % 3, i) for i in range(8)]
+        sources = []
+        for i in range(6):
+            ps = patches.PatchSet()
+            for pkg in rnd.sample(["pkg%d" % x for x in range(30)], 15):
+                ps.add(pkg, set(rnd.sample(tags, 2)), set(rnd.sample(tags, 2)))
+            sources.append(ps)
+
+        base = patches.PatchSet(fd=StringIO("pkg1: +facet0::tag0\npkg99: -facet1::tag1\n"))
+        expected = patches.PatchSet(fd=StringIO("pkg1: +facet0::tag0\npkg99: -facet1::tag1\n"))
+        for ps in sources:
+            expected.add_patchset(ps)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # Mix patchsets, sorted files and sorted streams
+            fname = os.path.join(tmpdir, "patch")
+            sources[1].write_sorted(fname, compress="gzip")
+            mixed = list(sources)
+            mixed[1] = fname
+            mixed[2] = sorted(sources[2].iteritems())
+            base.merge_many(mixed)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEquals(base.sorted_for_presentation, expected.sorted_for_presentation)
+
+        # Sources are not modified
+        before = [ps.sorted_for_presentation for ps in sources]
+        merged = patches.PatchSet()
+        merged.merge_many(sources)
+        merged.merge_many(sources)
+        self.assertEquals([ps.sorted_for_presentation for ps in sources], before)
+        # An unsorted source leaves the patchset untouched
+        before = merged.sorted_for_presentation
+        self.assertRaises(ValueError, merged.merge_many, [
+            sources[0], [("a", patches.Patch("+x::y")), ("pkg5", patches.Patch("+x::y")), ("b", patches.Patch("+x::y"))]])
+        self.assertEquals(merged.sorted_for_presentation, before)
+
+    def test_merge_many_files(self):
+        rnd = random.Random(13)
+        tags = ["facet%d::tag%d" % (i % 3, i) for i in range(8)]
+        sources = []
+        for i in range(60):
+            ps = patches.PatchSet()
+            for pkg in rnd.sample(["pkg%d" % x for x in range(200)], 50):
+                ps.add(pkg, set(rnd.sample(tags, 2)), set(rnd.sample(tags, 1)))
+            sources.append(ps)
+        expected = patches.PatchSet()
+        for ps in sources:
+            expected.add_patchset(ps)
+
+        tmpdir = tempfile.mkdtemp()
+        bufsize = patches.MERGE_BUFSIZE
+        try:
+            fnames = []
+            for i, ps in enumerate(sources):
+                fnames.append(os.path.join(tmpdir, "patch%d" % i))
+                ps.write_sorted(fnames[-1], compress=(None, "gzip", "bz2")[i % 3], block_size=256)
+            # Lines and compressed streams span many reads
+            patches.MERGE_BUFSIZE = 100
+            merged = patches.PatchSet()
+            merged.merge_many(fnames)
+        finally:
+            patches.MERGE_BUFSIZE = bufsize
+            shutil.rmtree(tmpdir)
+        self.assertEquals(merged.sorted_for_presentation, expected.sorted_for_presentation)
+
+def make_synthetic_db(seed=0, npkgs=400, ntags=25):
+    """
+    Build a random debtags.DB with a skewed tag distribution and a few
+    strong associations
+    """
+    rnd = random.Random(seed)
+    tags = ["facet%d::tag%d" % (i % 5, i) for i in range(ntags)]
+    lines = []
+    for i in range(npkgs):
+        ts = set(rnd.sample(tags[:rnd.randint(6, ntags)], rnd.randint(0, 6)))
+        # Add some strong associations
+        if tags[0] in ts and rnd.random() < 0.95: ts.add(tags[1])
+        if tags[2] in ts and tags[3] in ts: ts.add(tags[4])
+        if ts:
+            lines.append("pkg%d: %s\n" % (i, ", ".join(sorted(ts))))
+    db = debtags.DB()
+    db.read(lines)
+    return db
+
+def sorted_rules(rules):
+    return sorted((sorted(r.src), r.tgt, r.sus, r.conf) for r in rules)
+
+def brute_force_rules(db, miner, card_threshold):
+    """
+    Mine rules like the apriori binary, by trying every body and head
+    """
+    import itertools
+    items = set(t for t in db.iter_tags() if db.card(t) >= card_threshold)
+    rows = [ts & items for p, ts in db.iter_packages_tags()]
+    rows = [ts for ts in rows if ts]
+    n = len(rows)
+    smin = miner.min_support(n)
+    supp = lambda tags: sum(1 for ts in rows if tags <= ts)
+    res = []
+    maxbody = (miner.maxlen or len(items) + 1) - 1
+    for size in range(1, maxbody + 1):
+        for body in itertools.combinations(sorted(items), size):
+            body = frozenset(body)
+            nbody = supp(body)
+            if nbody < smin: continue
+            for head in items - body:
+                nhead = supp(frozenset((head,)))
+                both = supp(body | frozenset((head,)))
+                conf = 100.0 * both / nbody
+                if conf < miner.conf: continue
+                if miner.evaluation == "n":
+                    den = float(nbody) * (n - nbody) * nhead * (n - nhead)
+                    phi2 = (float(n) * both - float(nbody) * nhead) ** 2 / den if den else 0.0
+                    if 100.0 * phi2 < miner.eval_threshold: continue
+                res.append((sorted(body), head, float("%.1f" % (100.0 * nbody / n)), float("%.1f" % conf)))
+    return sorted(res)
+
+class TestApriori(unittest.TestCase):
+    # Options added to the defaults of each mode, for the engine comparisons
+    VARIANTS = ((False, ()), (True, ()), (False, ("-c0",)))
+
+    def mine(self, db, reverse=False, options=(), engine="builtin"):
+        a = apriori.Apriori(quiet=True, reverse=reverse)
+        a.conf_card_threshold = 10
+        a.conf_apriori_options = a.conf_apriori_options + ("-s-10",) + options
+        a.conf_engine = engine
+        # Compare everything that is mined, not only what the filter keeps
+        a.conf_filter = lambda r: True
+        return a, sorted_rules(a.run_apriori(db))
+
+    def test_builtin_matches_binary(self):
+        if not os.access("./apriori", os.X_OK):
+            self.skipTest("apriori binary not available")
+        db = make_synthetic_db()
+        for reverse, options in self.VARIANTS:
+            a, builtin = self.mine(db, reverse, options)
+            self.assertTrue(builtin)
+            self.assertEquals(builtin, self.mine(db, reverse, options, "binary")[1])
+
+    def test_builtin_matches_brute_force(self):
+        db = make_synthetic_db()
+        for reverse, options in self.VARIANTS:
+            a, builtin = self.mine(db, reverse, options)
+            self.assertTrue(builtin)
+            expected = brute_force_rules(db, apriori.Miner(a.conf_apriori_options), a.conf_card_threshold)
+            self.assertEquals(builtin, expected)
+
+    def test_builtin(self):
+        db = debtags.DB()
+        for i in range(5): db.insert("ab%d" % i, set(("a", "b")))
+        for i in range(5): db.insert("a%d" % i, set(("a",)))
+        for i in range(10): db.insert("c%d" % i, set(("c",)))
+        for i in range(3): db.insert("abc%d" % i, set(("a", "b", "c")))
+
+        res = sorted_rules(apriori.Miner(("-s-6", "-c60", "-n3")).mine(apriori.Transactions.from_db(db)))
+        self.assertEquals(res, [
+            (["a"], "b", 56.5, 61.5),
+            (["b"], "a", 34.8, 100.0),
+        ])
+
+    def test_reverse(self):
+        db = debtags.DB()
+        for i in range(40): db.insert("a%d" % i, set(("a", "c")))
+        for i in range(40): db.insert("b%d" % i, set(("b", "c")))
+        a = apriori.Apriori(quiet=True, reverse=True)
+        a.conf_engine = "builtin"
+        # a and b never occur together: the rules saying so have 0
+        # confidence
+        self.assertEquals(sorted_rules(a.run_apriori(db)), [
+            (["a"], "b", 50.0, 0.0),
+            (["a", "c"], "b", 50.0, 0.0),
+            (["b"], "a", 50.0, 0.0),
+            (["b", "c"], "a", 50.0, 0.0),
+        ])
+
+    def test_matrix(self):
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("numpy not available")
+        db = make_synthetic_db(seed=1)
+        tags = sorted(db.iter_tags())
+        matrix = numpy.array([[t in ts for t in tags] for p, ts in db.iter_packages_tags()])
+        trans = apriori.Transactions.from_matrix(matrix, tags)
+        self.assertEquals(trans.columns, apriori.Transactions.encode_columns(trans.rows, len(tags)))
+        miner = apriori.Miner(("-s-10", "-c30", "-n3"))
+        by_matrix = sorted_rules(miner.mine(trans))
+        by_db = sorted_rules(miner.mine(apriori.Transactions.from_db(db)))
+        self.assertTrue(by_db)
+        self.assertEquals(by_matrix, by_db)
+
+    def test_bitsetdb(self):
+        db = make_synthetic_db(seed=1)
+        db.insert("notags", set())
+        bits = bitsetdb.BitsetDB.from_db(db)
+        miner = apriori.Miner(("-s-10", "-c30", "-n3"))
+        by_db = sorted_rules(miner.mine(apriori.Transactions.from_db(db)))
+        self.assertTrue(by_db)
+        trans = apriori.Transactions.from_db(bits)
+        self.assertEquals(trans.count, db.package_count() - 1)
+        for tid, tag in enumerate(trans.tags):
+            self.assertEquals(trans.columns[tid], bits.tag_bits(tag))
+        self.assertEquals(apriori.Transactions.encode_columns(trans.rows, len(trans.tags)), trans.columns)
+        self.assertEquals(sorted_rules(miner.mine(trans)), by_db)
+
+        whitelist = set(sorted(db.iter_tags())[::2])
+        self.assertEquals(sorted_rules(miner.mine(apriori.Transactions.from_db(bits, whitelist))),
+                          sorted_rules(miner.mine(apriori.Transactions.from_db(db, whitelist))))
+
+class TestRuleIndex(unittest.TestCase):
+    def test_same_as_scan(self):
+        db = make_synthetic_db(seed=2)
+        rules = list(apriori.Miner(("-s-5", "-c20", "-n4")).mine(apriori.Transactions.from_db(db)))
+        self.assertTrue(rules)
+        index = apriori.RuleIndex(rules, db.card)
+        # Without cardinalities, rules are indexed by their first tag by name
+        plain = apriori.RuleIndex(rules)
+        for pkg, tags in db.iter_packages_tags():
+            expected = set(r.tgt for r in rules if r.src.issubset(tags) and r.tgt not in tags)
+            self.assertEquals(index.consequents(tags), expected)
+            self.assertEquals(plain.consequents(tags), expected)
+
+class TestRuleStore(unittest.TestCase):
+    def test_build(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            tags_fname = os.path.join(tmpdir, "tags")
+            store_fname = os.path.join(tmpdir, "rules")
+            db = make_synthetic_db(seed=3)
+            with open(tags_fname, "w") as fd:
+                for pkg, tags in db.iter_packages_tags():
+                    print >>fd, "%s: %s" % (pkg, ", ".join(sorted(tags)))
+
+            a = apriori.Apriori(quiet=True)
+            a.conf_engine = "builtin"
+            a.conf_card_threshold = 10
+            a.conf_apriori_options = ("-s-10", "-c30", "-n3")
+            expected = list(a.run_apriori(apriori.Apriori.read_debtags_db(tags_fname)))
+            self.assertTrue(expected)
+
+            with rulestore.build(store_fname, tags_fname, a) as store:
+                self.assertEquals(sorted_rules(store), sorted_rules(expected))
+                self.assertEquals(store[-1], list(store)[-1])
+            self.assertRaises(ValueError, store.__getitem__, 0)
+
+            # Unchanged inputs reuse the store, changed inputs rebuild it
+            os.utime(store_fname, (1000, 1000))
+            rulestore.build(store_fname, tags_fname, a).close()
+            self.assertEquals(os.stat(store_fname).st_mtime, 1000)
+            a.conf_apriori_options = ("-s-10", "-c60", "-n3")
+            with rulestore.build(store_fname, tags_fname, a) as store:
+                self.assertNotEquals(os.stat(store_fname).st_mtime, 1000)
+                self.assertEquals(sorted_rules(store), sorted_rules(r for r in expected if r.conf >= 60))
+
+            # Rules mined by the other engine are not reused
+            a.conf_engine = "binary"
+            with rulestore.RuleStore(store_fname) as store:
+                self.assertFalse(store.matches(store.fingerprint, a.parameters()))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestSweep(unittest.TestCase):
+    def test_sweep(self):
+        db = make_synthetic_db(seed=4)
+        configs = dict()
+        for name, reverse in ("forward", False), ("reverse", True):
+            a = apriori.Apriori(quiet=True, reverse=reverse)
+            a.conf_engine = "builtin"
+            a.conf_card_threshold = 10
+            a.conf_filter = lambda r: True
+            a.conf_apriori_options = a.conf_apriori_options + ("-s-10",)
+            configs[name] = a
+        expected = dict((name, sorted_rules(a.run_apriori(db))) for name, a in configs.iteritems())
+        self.assertTrue(expected["forward"])
+        self.assertTrue(expected["reverse"])
+        for processes in None, 2:
+            res = apriori.sweep(db, configs, processes=processes)
+            self.assertEquals(dict((name, sorted_rules(rules)) for name, rules in res.iteritems()), expected)
+
+class TestAprioriOutput(unittest.TestCase):
+    def test_parse(self):
+        output = "\n".join([
+            "apriori - find association rules with the apriori algorithm",
+            "b <- a (56.5, 61.5)",
+            "c <- a b (34.8, 37.5)",
+            "a <- b (34.8, 100.0)",
+            "c <- (100.0, 56.5)",
+            "d <- a b (34.8, 12.0)",
+        ])
+        a = apriori.Apriori()
+        a.conf_bufsize = 7
+        res = list(a._parse_apriori_output(StringIO(output)))
+        self.assertEquals(res, [
+            (frozenset(["a"]), "b", 56.5, 61.5),
+            (frozenset(["a", "b"]), "c", 34.8, 37.5),
+            (frozenset(["b"]), "a", 34.8, 100.0),
+            (frozenset(["a", "b"]), "d", 34.8, 12.0),
+        ])
+        # Equal antecedents are shared
+        self.assertIs(res[1].src, res[3].src)
+
+        res = list(a._parse_apriori_output(StringIO("1 <- 0 2 (1.0, 2.0)\n"), ["a", "b", "c"]))
+        self.assertEquals(res, [(frozenset(["a", "c"]), "b", 1.0, 2.0)])
+
+class TestRulePruner(unittest.TestCase):
+    def test_prune(self):
+        db = make_synthetic_db(seed=5)
+        rules = list(apriori.Miner(("-s-5", "-c20", "-n4")).mine(apriori.Transactions.from_db(db)))
+        pruned = list(apriori.RulePruner(ordered=True).prune(rules))
+        pruner = apriori.RulePruner()
+        unordered = list(pruner.prune(reversed(rules)))
+        self.assertEquals(sorted_rules(unordered), sorted_rules(pruned))
+        self.assertEquals(pruner.dropped, len(rules) - len(pruned))
+        self.assertTrue(pruner.dropped > 0)
+
+        # The suggested tags do not change
+        full = apriori.RuleIndex(rules)
+        small = apriori.RuleIndex(pruned)
+        for pkg, tags in db.iter_packages_tags():
+            self.assertEquals(small.consequents(tags), full.consequents(tags))
+
+class TestRuleQuery(unittest.TestCase):
+    def test_query(self):
+        db = make_synthetic_db(seed=6)
+        rules = list(apriori.Miner(("-s-5", "-c20", "-n3")).mine(apriori.Transactions.from_db(db)))
+        self.assertTrue(rules)
+        query = apriori.RuleQuery(db)
+        for rule, res in zip(rules, query.query_many((r.src, r.tgt) for r in rules)):
+            self.assertEquals(res.src, rule.src)
+            self.assertEquals(res.tgt, rule.tgt)
+            self.assertEquals(float("%.1f" % res.sus), rule.sus)
+            self.assertEquals(float("%.1f" % res.conf), rule.conf)
+
+        self.assertEquals(query.support(()), db.package_count())
+        self.assertEquals(query.support(("facet0::tag0",)), len(db.packages_of_tag("facet0::tag0")))
+        res = query.query(("facet0::tag0",), "nonexistent::tag")
+        self.assertEquals(res.conf, 0.0)
+
+class TestTagSnapshot(unittest.TestCase):
+    def test_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "tags")
+            with open(fname, "w") as fd:
+                print >>fd, "a, b: role::program, special::not-yet-tagged"
+                print >>fd, "c: role::devel-lib"
+
+            # Snapshots are opt-in
+            apriori.Apriori.read_debtags_db(fname)
+            self.assertEquals(os.listdir(tmpdir), ["tags"])
+
+            db = apriori.Apriori.read_debtags_db(fname, snapshot=True)
+            self.assertEquals(len(os.listdir(tmpdir)), 2)
+            cached = apriori.Apriori.read_debtags_db(fname, snapshot=True)
+            self.assertEquals(cached.db, db.db)
+            self.assertEquals(cached.rdb, db.rdb)
+            self.assertEquals(cached.tags_of_package("a"), set(("role::program",)))
+
+            # The snapshot is specific to the filter, and readers with
+            # different filters do not replace each other's snapshots
+            self.assertEquals(tagsnapshot.read_tags(fname).tags_of_package("a"),
+                              set(("role::program", "special::not-yet-tagged")))
+            self.assertEquals(len(os.listdir(tmpdir)), 3)
+            for key in "", "^(?:special::.+|.+:special:.+|.+:TODO|.+:todo)$":
+                self.assertIsNotNone(tagsnapshot.read_snapshot(tagsnapshot.snapshot_name(fname, key), fname, key))
+
+            # Snapshots can be kept elsewhere
+            cachedir = os.path.join(tmpdir, "cache")
+            os.mkdir(cachedir)
+            tagsnapshot.read_tags(fname, snapshot_dir=cachedir)
+            self.assertEquals(len(os.listdir(cachedir)), 1)
+
+            # Touching the file does not invalidate the snapshot
+            os.utime(fname, (1000, 1000))
+            self.assertIsNotNone(tagsnapshot.read_snapshot(tagsnapshot.snapshot_name(fname), fname, ""))
+
+            # Changing the file invalidates the snapshot
+            with open(fname, "a") as fd:
+                print >>fd, "d: role::documentation"
+            self.assertEquals(tagsnapshot.read_tags(fname).tags_of_package("d"),
+                              set(("role::documentation",)))
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestBitsetDB(unittest.TestCase):
+    def assertSameDB(self, bdb, db):
+        self.assertEquals(dict(bdb.iter_packages_tags()), db.db)
+        self.assertEquals(dict(bdb.iter_tags_packages()), db.rdb)
+        self.assertEquals(bdb.package_count(), db.package_count())
+        self.assertEquals(bdb.tag_count(), db.tag_count())
+        for tag in db.iter_tags():
+            self.assertEquals(bdb.card(tag), db.card(tag))
+        for pkg in db.iter_packages():
+            self.assertTrue(bdb.has_package(pkg))
+            self.assertEquals(bdb.tags_of_package(pkg), db.tags_of_package(pkg))
+
+    def test_read_api(self):
+        db = make_synthetic_db(seed=7)
+        bdb = bitsetdb.BitsetDB.from_db(db)
+        self.assertSameDB(bdb, db)
+        self.assertFalse(bdb.has_package("missing"))
+        self.assertFalse(bdb.has_tag("missing::tag"))
+        self.assertEquals(bdb.card("missing::tag"), 0)
+        self.assertEquals(bdb.tags_of_package("missing"), set())
+
+        tags = ("facet0::tag0", "facet1::tag1")
+        both = db.packages_of_tag(tags[0]) & db.packages_of_tag(tags[1])
+        self.assertEquals(bdb.packages_of_bits(bdb.with_all(tags)), both)
+        self.assertEquals(bdb.count(bdb.with_all(tags)), len(both))
+        self.assertEquals(bdb.packages_of_bits(bdb.with_any(tags)),
+                          db.packages_of_tag(tags[0]) | db.packages_of_tag(tags[1]))
+
+        query = apriori.RuleQuery(db)
+        bquery = apriori.RuleQuery(bdb)
+        self.assertEquals(bquery.count, query.count)
+        self.assertEquals(bquery.query(tags[:1], tags[1]), query.query(tags[:1], tags[1]))
+
+        for protocol in 0, 2:
+            self.assertSameDB(pickle.loads(pickle.dumps(bdb, protocol)), db)
+
+    def test_sources(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(tmpdir, "tags-stable")
+            with open(fname, "w") as fd:
+                print >>fd, "a, b: role::program, special::not-yet-tagged"
+                print >>fd, "c: role::devel-lib"
+            db = apriori.Apriori.read_debtags_db(fname, snapshot=False)
+            self.assertSameDB(apriori.Apriori.read_debtags_db(fname, snapshot=False, bitset=True), db)
+            for i in range(2):
+                # Building and then using the snapshot
+                self.assertSameDB(apriori.Apriori.read_debtags_db(fname, snapshot=True, bitset=True), db)
+
+            sources = datasources.Sources(tmpdir)
+            sources.load(bitset=True)
+            self.assertIsInstance(sources["stabletags"].db, bitsetdb.BitsetDB)
+            self.assertEquals(sources["stabletags"].db.card("special::not-yet-tagged"), 2)
+
+            # Tags first seen in a child process get IDs that are only valid
+            # there
+            with open(fname, "w") as fd:
+                print >>fd, "a, b: childonly::one, childonly::two"
+                print >>fd, "c: childonly::three"
+            sources = datasources.Sources(tmpdir)
+            sources.load(concurrency="processes", bitset=True)
+            db = debtags.DB()
+            with open(fname) as fd:
+                db.read(fd)
+            self.assertSameDB(sources["stabletags"].db, db)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestBinPackages(unittest.TestCase):
+    SAMPLE = "\n".join([
+        "# comment",
+        "",
+        "Package: foo",
+        "Version: 1.0-1",
+        "Section: contrib/games",
+        "Architecture: amd64, i386",
+        "depends:",
+        " libc6 (>= 2.11),",
+        " libgtk2.0-0 | libgtk3",
+        "Recommends: a,, b ",
+        "Description: short",
+        " Long description",
+        " .",
+        "  verbatim",
+        "  ",
+        "Package: bar",
+        "Source: foo",
+        "Version: 1.0-1",
+        "Architecture: all",
+        "Description: no long description",
+        "",
+        "Package: nodesc",
+        "Version: 1.0",
+        "",
+    ])
+
+    def test_load(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "all-merged"), "w") as fd:
+                fd.write(self.SAMPLE)
+            src = datasources.BinPackages.create(tmpdir)
+            src.load()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        self.assertEquals(sorted(src.by_name.keys()), ["bar", "foo"])
+        self.assertEquals(sorted(src.by_section.keys()), ["games", "unknown"])
+        foo = src.by_name["foo"]
+        self.assertEquals(foo, datasources.Pkg(
+            "foo", "1.0-1", "foo", "games", "short", "Long description\n.\n verbatim",
+            ["amd64", "i386"], [], ["\n libc6 (>= 2.11)", "libgtk2.0-0 | libgtk3"],
+            ["a", "b"], [], [], []))
+        self.assertEquals(src.by_name["bar"].src, "foo")
+        self.assertEquals(src.by_name["bar"].ldesc, "")
+
+    def test_compact(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "all-merged"), "w") as fd:
+                fd.write(self.SAMPLE)
+                fd.write(self.SAMPLE.replace("Package: foo", "Package: baz"))
+            full = datasources.BinPackages.create(tmpdir)
+            full.load()
+            compact = datasources.BinPackages.create(tmpdir)
+            compact.load(compact=True)
+            # Long descriptions are only read when used
+            foo = compact.by_name["foo"]
+            compact.depgraph
+            self.assertIsNone(compact.store.fd)
+            self.assertEquals(foo.sdesc, "short")
+            self.assertIsNone(compact.store.fd)
+            self.assertEquals(foo.ldesc, "Long description\n.\n verbatim")
+            self.assertEquals(foo[5], foo.ldesc)
+            self.assertEquals(pickle.loads(pickle.dumps(foo)), full.by_name["foo"])
+
+            self.assertEquals(compact.by_name, full.by_name)
+            self.assertEquals(compact.by_section, full.by_section)
+            self.assertEquals(compact.by_name["baz"].ldesc, "Long description\n.\n verbatim")
+            self.assertEquals(compact.by_section.get("nonexistent", ()), ())
+
+            # Used as a plain tuple, the long description is read first
+            plain = full.by_name["baz"]
+            for pkg in compact.by_name["baz"], compact.by_name["baz"]:
+                self.assertTrue(plain.ldesc in pkg)
+            self.assertEquals(compact.by_name["baz"].count(plain.ldesc), 1)
+            self.assertEquals(compact.by_name["baz"].index(plain.ldesc), 5)
+            self.assertEquals(tuple(compact.by_name["baz"]), tuple(plain))
+            self.assertEquals("%s %s %s %s %s %s" % tuple(compact.by_name["baz"])[:6],
+                              "%s %s %s %s %s %s" % plain[:6])
+            self.assertFalse(compact.by_name["baz"] < plain or compact.by_name["baz"] > plain)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parallel(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "all-merged"), "w") as fd:
+                for i in range(50):
+                    fd.write(self.SAMPLE.replace("Package: foo", "Package: foo%d" % i))
+                    fd.write("\n")
+            seq = datasources.BinPackages.create(tmpdir)
+            seq.load()
+            par = datasources.BinPackages.create(tmpdir)
+            par.load(workers=3)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEquals(len(par.by_name), 51)
+        self.assertEquals(par.by_name, seq.by_name)
+        self.assertEquals(par.by_section, seq.by_section)
+
+class TestDepGraph(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "all-merged"), "w") as fd:
+                fd.write(TestBinPackages.SAMPLE)
+            self.src = datasources.BinPackages.create(tmpdir)
+            self.src.load()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_parse_relation(self):
+        self.assertEquals(depgraph.parse_relation("libgtk2.0-0 (>= 2.24) | libgtk3"),
+                          [("libgtk2.0-0", (">=", "2.24")), ("libgtk3", None)])
+        self.assertEquals(depgraph.parse_relation(" python:any (<<3)"),
+                          [("python", ("<<", "3"))])
+
+    def test_graph(self):
+        graph = self.src.depgraph
+        self.assertEquals(graph.real, 2)
+        self.assertEquals(graph.depends("foo"), ["a", "b", "libc6", "libgtk2.0-0", "libgtk3"])
+        self.assertEquals(graph.depends("foo", fields=("deps",), first_only=True), ["libc6", "libgtk2.0-0"])
+        self.assertEquals(graph.depends("bar"), [])
+        self.assertEquals(graph.rdepends("libgtk3"), ["foo"])
+        self.assertEquals(graph.rdepends("libgtk3", first_only=True), [])
+        self.assertEquals(graph.rdepends("foo"), [])
+        self.assertEquals(graph.rdepends("missing"), [])
+        self.assertIn(("libc6", "deps", 0, (">=", "2.11")), list(graph.edges(graph.id("foo"))))
+
+        rule = autotag.RuleUIToolkit(dict(binpackages=self.src))
+        self.assertEquals(list(rule.make_patch()), [("foo", set(["uitoolkit::gtk"]), frozenset())])
+
+class TestClosure(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "all-merged"), "w") as fd:
+                for name, deps in (("a", "b"), ("b", "c"), ("c", "b, libqt4-gui"),
+                                   ("d", "a | x"), ("e", "e"), ("f", "")):
+                    print >>fd, "Package: %s\nVersion: 1\nDepends: %s\nDescription: %s\n" % (name, deps, name)
+            src = datasources.BinPackages.create(tmpdir)
+            src.load()
+        finally:
+            shutil.rmtree(tmpdir)
+        self.closure = src.depgraph.closure()
+
+    def test_reachable(self):
+        c = self.closure
+        self.assertEquals(c.reachable("a"), set(["b", "c", "libqt4-gui"]))
+        self.assertEquals(c.reachable("b"), set(["b", "c", "libqt4-gui"]))
+        self.assertEquals(c.reachable("d"), set(["a", "b", "c", "x", "libqt4-gui"]))
+        self.assertEquals(c.reachable("d", max_depth=2), set(["a", "b", "x"]))
+        self.assertEquals(c.reachable("e"), set(["e"]))
+        self.assertEquals(c.reachable("f"), set())
+        self.assertEquals(c.reachable("missing"), set())
+        first = c.graph.closure(first_only=True)
+        self.assertEquals(first.reachable("d"), set(["a", "b", "c", "libqt4-gui"]))
+
+    def test_depends_on(self):
+        c = self.closure
+        is_qt = lambda name: name.startswith("libqt")
+        self.assertEquals(sorted(c.packages_depending_on(is_qt)), ["a", "b", "c", "d"])
+        self.assertTrue(c.depends_on("d", is_qt))
+        self.assertFalse(c.depends_on("d", is_qt, max_depth=3))
+        self.assertTrue(c.depends_on("d", is_qt, max_depth=4))
+        self.assertTrue(c.depends_on("e", lambda name: name == "e"))
+        self.assertFalse(c.depends_on("a", lambda name: name == "a"))
+
+class TestSrcPackages(unittest.TestCase):
+    SAMPLE = "\n".join([
+        "Package: foo",
+        "Version: 1.0-1",
+        "Maintainer: Foo Maintainer <foo@example.org>",
+        "Uploaders: A <a@example.org>, B <b@example.org>",
+        "Build-Depends: debhelper (>= 9), libgtk2.0-dev",
+        "",
+        "Package: bar",
+        "Version: 2.0",
+        "Maintainer: Bar Team <bar@example.org>",
+        "Build-Depends-Indep: python",
+        "",
+    ])
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, "all-merged-sources"), "w") as fd:
+            fd.write(self.SAMPLE)
+        self.src = datasources.SrcPackages.create(self.tmpdir)
+        self.src.load()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_sources(self):
+        foo, bar = self.src.sources()
+        self.assertEquals(foo.name, "foo")
+        self.assertEquals(foo.maint, ("Foo Maintainer", "foo@example.org"))
+        self.assertEquals(foo.upls, [("A", "a@example.org"), ("B", "b@example.org")])
+        self.assertEquals(foo.bd, ["debhelper (>= 9)", "libgtk2.0-dev"])
+        self.assertEquals(bar.upls, [])
+        self.assertEquals(bar.bdi, ["python"])
+
+        # Sources still work like the Src namedtuple
+        plain = datasources.Src("foo", "1.0-1", ("Foo Maintainer", "foo@example.org"),
+                                [("A", "a@example.org"), ("B", "b@example.org")],
+                                ["debhelper (>= 9)", "libgtk2.0-dev"], [])
+        self.assertEquals(foo, plain)
+        self.assertEquals(foo[2], plain.maint)
+        self.assertEquals(foo._asdict(), plain._asdict())
+        self.assertEquals(foo._replace(ver="1.1"), plain._replace(ver="1.1"))
+        for protocol in 0, 2:
+            self.assertEquals(pickle.loads(pickle.dumps(foo, protocol)), plain)
+
+        # Fresh sources parse their maintainers when used as plain tuples
+        get = lambda: self.src.get("foo")
+        self.assertTrue(plain.maint in get())
+        self.assertEquals(get().count(plain.upls), 1)
+        self.assertEquals(get().index(plain.upls), 3)
+        self.assertEquals(tuple(get()), tuple(plain))
+        self.assertTrue(get() == plain and plain == get() and not get() != plain)
+        self.assertEquals(sorted([get(), plain._replace(name="a")])[1], plain)
+
+    def test_get(self):
+        expected = dict((s.name, s) for s in self.src.sources())
+        self.assertEquals(self.src.get("bar"), expected["bar"])
+        self.assertIsNone(self.src.get("missing"))
+        self.assertEquals(self.src.get_many(["foo", "missing", "bar"]), expected)
+        self.assertTrue(os.path.exists(self.src.datafile + ".index"))
+
+        # A fresh source reuses the saved index
+        src = datasources.SrcPackages.create(self.tmpdir)
+        src.load()
+        self.assertEquals(src.index(), self.src.index())
+        self.assertEquals(src.get("foo"), expected["foo"])
+
+class TestSourceJoin(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        with open(os.path.join(self.tmpdir, "all-merged"), "w") as fd:
+            fd.write(TestBinPackages.SAMPLE)
+            fd.write("\nPackage: baz\nSource: bar (2.0)\nVersion: 2.0+b1\nDescription: baz\n")
+        with open(os.path.join(self.tmpdir, "all-merged-sources"), "w") as fd:
+            fd.write(TestSrcPackages.SAMPLE)
+            fd.write("\nPackage: nobinaries\nVersion: 1\nMaintainer: Bar Team <bar@example.org>\n")
+        self.binpackages = datasources.BinPackages.create(self.tmpdir)
+        self.binpackages.load()
+        self.srcpackages = datasources.SrcPackages.create(self.tmpdir)
+        self.srcpackages.load()
+        self.join = datasources.SourceJoin(self.binpackages, self.srcpackages)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_groups(self):
+        groups = dict((src.name, sorted(p.name for p in pkgs)) for src, pkgs in self.join.groups())
+        self.assertEquals(groups, dict(foo=["bar", "foo"], bar=["baz"]))
+
+    def test_maintainers(self):
+        self.assertEquals(self.join.by_maintainer(), {
+            "foo@example.org": set(["foo", "bar"]),
+            "bar@example.org": set(["baz"]),
+        })
+        self.assertEquals(sorted(self.join.by_maintainer(uploaders=True).keys()),
+                          ["a@example.org", "b@example.org", "bar@example.org", "foo@example.org"])
+        groups = list(self.join.maintainer_groups(["A@example.org"], uploaders=True))
+        self.assertEquals([src.name for src, pkgs in groups], ["foo"])
+        self.assertEquals(list(self.join.maintainer_groups(["A@example.org"])), [])
+
+class TestTagInterner(unittest.TestCase):
+    def test_interner(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with open(os.path.join(tmpdir, "vocabulary"), "w") as fd:
+                for facet in "role", "use":
+                    print >>fd, "Facet: %s\nDescription: %s\n" % (facet, facet)
+                for tag in "use::viewing", "role::program", "role::plugin":
+                    print >>fd, "Tag: %s\nDescription: %s\n" % (tag, tag)
+            voc = datasources.Vocabulary.create(tmpdir)
+            voc.load()
+        finally:
+            shutil.rmtree(tmpdir)
+
+        interner = tagids.TagInterner()
+        interner.seed(voc)
+        self.assertEquals(interner.tags, ["role::plugin", "role::program", "use::viewing"])
+        self.assertEquals(interner.facets, ["role", "use"])
+        self.assertEquals(interner.tag_id("role::program"), 1)
+        self.assertEquals(interner.facet_of(2), interner.facet_id("use"))
+
+        # New tags and facets are added on demand
+        tid = interner.tag_id("game::toys")
+        self.assertEquals(tid, 3)
+        self.assertEquals(interner.facet(interner.facet_of(tid)), "game")
+
+        tags = ["role::program", "game::toys"]
+        ids = interner.tag_ids(tags)
+        self.assertEquals(ids, frozenset([1, 3]))
+        self.assertEquals(interner.tag_names(ids), frozenset(tags))
+        self.assertEquals(interner.facet_ids(ids), frozenset([0, 2]))
+        mask = interner.mask(tags)
+        self.assertEquals(mask, interner.mask_of_ids(ids))
+        self.assertEquals(interner.ids_of_mask(mask), [1, 3])
+        self.assertEquals(interner.tag_names_of_mask(mask), frozenset(tags))
+        self.assertTrue(interner.has_facet(mask, "role"))
+        self.assertFalse(interner.has_facet(mask, "use"))
+        self.assertFalse(interner.has_facet(mask, "missing"))
+
+    def test_load_order(self):
+        tmpdir = tempfile.mkdtemp()
+        saved = tagids.interner
+        try:
+            with open(os.path.join(tmpdir, "vocabulary"), "w") as fd:
+                print >>fd, "Facet: role\nDescription: role\n"
+                for tag in "role::program", "role::plugin":
+                    print >>fd, "Tag: %s\nDescription: %s\n" % (tag, tag)
+            with open(os.path.join(tmpdir, "tags-stable"), "w") as fd:
+                print >>fd, "a: use::viewing, game::toys, role::program"
+            for concurrency in None, "threads", "processes":
+                tagids.interner = tagids.TagInterner()
+                sources = datasources.Sources(tmpdir)
+                sources.load(concurrency=concurrency, bitset=True)
+                # Vocabulary tags come first, whatever the loading order
+                self.assertEquals(tagids.interner.tags[:2], ["role::plugin", "role::program"])
+                self.assertEquals(sources["stabletags"].db.tags_of_package("a"),
+                                  set(("use::viewing", "game::toys", "role::program")))
+        finally:
+            tagids.interner = saved
+            shutil.rmtree(tmpdir)
+
+class TestSources(unittest.TestCase):
+    def setUp(self):
+        self.datadir = tempfile.mkdtemp()
+        with open(os.path.join(self.datadir, "all-merged"), "w") as fd:
+            fd.write(TestBinPackages.SAMPLE)
+        with open(os.path.join(self.datadir, "tags-stable"), "w") as fd:
+            print >>fd, "foo: role::program, uitoolkit::gtk"
+            print >>fd, "bar: role::documentation"
+        with open(os.path.join(self.datadir, "popcon"), "w") as fd:
+            print >>fd, "# comment"
+            print >>fd, "1     foo     100   80   10   10   0  (Someone)"
+            print >>fd, "------------------------------------------------"
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_load(self):
+        expected = datasources.Sources(self.datadir)
+        timings = expected.load(snapshot=False)
+        self.assertEquals(sorted(timings.keys()), ["binpackages", "popcon", "stabletags"])
+
+        for concurrency in "threads", "processes":
+            sources = datasources.Sources(self.datadir)
+            timings = sources.load(concurrency=concurrency, snapshot=False)
+            self.assertEquals(sorted(timings.keys()), sorted(expected.keys()))
+            self.assertEquals(sources["binpackages"].by_name, expected["binpackages"].by_name)
+            self.assertEquals(sources["popcon"].votes, dict(foo=80))
+            self.assertEquals(sources["stabletags"].db.db, expected["stabletags"].db.db)
+
+    def test_reload(self):
+        class NeedsPopcon(datasources.Action):
+            NEED_SOURCES = ("popcon",)
+        class NeedsTags(datasources.Action):
+            NEED_SOURCES = ("binpackages", "stabletags")
+
+        sources = datasources.Sources(self.datadir)
+        sources.load(snapshot=False)
+        actions = [NeedsPopcon, NeedsTags]
+        # Loading does not hash the data files: checking for changes does
+        fname = os.path.join(self.datadir, "tags-stable")
+        self.assertIsNone(sources["stabletags"].loaded_fingerprint[2])
+        self.assertEquals(sources.reload(actions, snapshot=False), ([], []))
+        self.assertEquals(sources["stabletags"].loaded_fingerprint[2], utils.file_fingerprint(fname))
+
+        # Touching a file without changing it does not trigger a reload, and
+        # the file is not hashed again on the next check
+        os.utime(fname, (1000, 1000))
+        self.assertEquals(sources.reload(actions, snapshot=False), ([], []))
+        self.assertEquals(sources["stabletags"].loaded_fingerprint[1], 1000)
+
+        with open(os.path.join(self.datadir, "popcon"), "w") as fd:
+            print >>fd, "1     foo     100   42   10   10   0  (Someone)"
+        changed, affected = sources.reload(actions, snapshot=False)
+        self.assertEquals(changed, ["popcon"])
+        self.assertEquals(affected, [NeedsPopcon])
+        self.assertEquals(sources["popcon"].votes, dict(foo=42))
+        self.assertEquals(sources.reload(actions, snapshot=False), ([], []))
+
+        # Fingerprints taken in the loading processes are kept
+        with open(os.path.join(self.datadir, "popcon"), "w") as fd:
+            print >>fd, "1     foo     100   7   10   10   0  (Someone)"
+        self.assertEquals(sources.reload(actions, concurrency="processes", snapshot=False)[0], ["popcon"])
+        self.assertEquals(sources["popcon"].votes, dict(foo=7))
+        self.assertEquals(sources.reload(actions, concurrency="threads", snapshot=False), ([], []))
+
+        # State cached from the previous load is dropped
+        self.assertEquals(sources["binpackages"].depgraph.depends("bar"), [])
+        with open(os.path.join(self.datadir, "all-merged"), "a") as fd:
+            fd.write("\nPackage: bar\nVersion: 2\nDepends: foo\nDescription: bar\n")
+        self.assertEquals(sources.reload(actions, concurrency="processes", snapshot=False)[0], ["binpackages"])
+        self.assertEquals(sources["binpackages"].by_name["bar"].deps, ["foo"])
+        self.assertEquals(sources["binpackages"].depgraph.depends("bar"), ["foo"])
+
+class TestUtils(unittest.TestCase):
+    def test_read_lines(self):
+        text = "one\ntwo\n\nthree\nfour"
+        for bufsize in 1, 3, 4, 1000:
+            self.assertEquals(list(utils.read_lines(StringIO(text), bufsize)), text.split("\n"))
+            self.assertEquals(list(utils.read_lines(StringIO(text), bufsize, size=9)), ["one", "two", ""])
+            self.assertEquals(list(utils.read_lines(StringIO(text + "\n"), bufsize)), text.split("\n"))
+        self.assertEquals(list(utils.read_lines(StringIO(""))), [])
@@ -1,6 +1,7 @@
 import textwrap
 import tempfile
 import os.path
+import hashlib
 from cStringIO import StringIO
 
 # From http://code.activestate.com/recipes/363602-lazy-property-evaluation/
@@ -43,6 +44,85 @@ class atomic_writer(object):
         self.outfd.close()
         return False
 
+def file_fingerprint(fname):
+    """
+    Return a string identifying the contents of a file
+    """
+    digest = hashlib.sha1()
+    with open(fname, "rb") as fd:
+        while True:
+            buf = fd.read(1024 * 1024)
+            if not buf: break
+            digest.update(buf)
+    return digest.hexdigest()
+
+def read_chunks(fd, bufsize=1024 * 1024, size=None):
+    """
+    Generate the contents of a file in blocks of bufsize bytes.
+
+    If size is given, stop after reading that many bytes.
+    """
+    while size is None or size > 0:
+        buf = fd.read(bufsize if size is None else min(bufsize, size))
+        if not buf: break
+        if size is not None:
+            size -= len(buf)
+        yield buf
+
+def split_lines(chunks):
+    """
+    Generate the lines in a sequence of blocks of text, without line
+    terminators
+    """
+    tail = ""
+    for buf in chunks:
+        # Iterating a StringIO splits off one line at a time, instead of
+        # making a list with all the lines in the block
+        lines = StringIO(tail + buf)
+        tail = ""
+        for line in lines:
+            if line[-1:] == "\n":
+                yield line[:-1]
+            else:
+                tail = line
+    if tail:
+        yield tail
+
+def read_lines(fd, bufsize=1024 * 1024, size=None):
+    """
+    Generate the lines of a file, without line terminators, reading it in
+    large blocks.
+
+    If size is given, stop after reading that many bytes.
+    """
+    return split_lines(read_chunks(fd, bufsize, size))
+
+def file_key(fname):
+    """
+    Return the size and mtime of a file
+    """
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime
+
+def unchanged_file_key(fname, size, mtime, digest):
+    """
+    Check if a file still has the contents it had when it had the given size,
+    mtime and file_fingerprint, hashing it only if it was touched.
+
+    Return its current (size, mtime) if it is unchanged, else None. digest
+    can be None if it was never computed: touched files then count as
+    changed.
+    """
+    key = file_key(fname)
+    if key[0] != size:
+        return None
+    if key[1] == mtime:
+        return key
+    # Same size but touched: check if the contents changed
+    if digest is None or file_fingerprint(fname) != digest:
+        return None
+    return key
+
 def splitdesc(text):
     if text is None:
         return "", ""